@@ -1,16 +1,34 @@
 #!/usr/bin/python
 
-import os, sys, gobject, stat, time, re
-import gtk
-
-import gst, gst.pbutils
-
-from matplotlib.figure import Figure
-from matplotlib.backends.backend_gtkagg import FigureCanvasGTKAgg as FigureCanvas
-import scipy.io.wavfile as wavfile
-
-import wave
+import time
+startup_time = time.time()
+
+import os, sys, errno, gobject, stat, re, hashlib, threading, urllib, json, Queue
+import argparse, csv, multiprocessing, contextlib, functools
+from collections import OrderedDict, namedtuple, deque
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+import gtk, gio, cairo
+
+import gst
+
+# gst.pbutils is slow to import and only needed once a file is probed,
+# so it is imported on first use.
+
+import struct
 import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+gobject.threads_init()
 
 license = """
 BeatNitPicker is free software; you can redistribute it and/or modify
@@ -33,19 +51,41 @@ menu = """
             <menuitem action="Quit"/>
         </menu>
         <menu action="Edit">
+            <menuitem action="PlayThrough"/>
+            <menuitem action="Shuffle"/>
+            <menuitem action="Loop"/>
+            <separator/>
+            <menuitem action="Waveform"/>
+            <menuitem action="Spectrogram"/>
+            <separator/>
             <menuitem action="Preferences"/>
         </menu>
         <menu action="Help">
+            <menuitem action="CacheStats"/>
+            <menuitem action="Latency"/>
             <menuitem action="About"/>
         </menu>
     </menubar>
 </ui>
 """
 
-if len(sys.argv) > 1:
-    clipath = str(sys.argv[1])
-else:
-    clipath = False
+# Set from the command line, see parse_args()
+clipath = False
+# Folders given on the command line are indexed for search
+library_roots = []
+# Where to dump the latency stats on exit, see LatencyStats
+latency_log = os.environ.get("BNP_LATENCY_LOG")
+
+cache_dir = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "beatnitpicker")
+
+audio_formats = [ ".wav", ".mp3", ".ogg", ".flac", ".MP3", ".FLAC", ".OGG", ".WAV", "wma" ]
+
+# File list model columns
+COL_NAME, COL_PATH, COL_ISDIR, COL_SIZE, COL_MODE, COL_MTIME, COL_AUDIO, COL_BPM = range(8)
+list_columns = (str, str, bool, gobject.TYPE_INT64, int, float, bool, float)
+
+# Number of time columns of the spectrogram image kept per file
+SPECTROGRAM_COLUMNS = 1024
 
 def bytestomegabytes(bytes):
     return (bytes / 1024) / 1024
@@ -59,27 +99,241 @@ def k_to_m(num):
     return "%3.1f%s" % (num, 'TB')
 
 
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_IEEE_FLOAT = 0x0003
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+
+def file_row(name, path, filestat):
+    """Build a file list model row from an already fetched stat result."""
+    isdir = stat.S_ISDIR(filestat.st_mode)
+    return [name, path, isdir, filestat.st_size, filestat.st_mode, filestat.st_mtime,
+            not isdir and name.endswith(tuple(audio_formats)), 0.0]
+
+
+def _stat(path):
+    """Stat path, falling back to the link itself for dangling symlinks; None if it is gone."""
+    try:
+        return os.stat(path)
+    except OSError:
+        try:
+            return os.lstat(path)
+        except OSError:
+            return None
+
+
+def iter_directory(dirname, batch=256, first=None):
+    """
+    Yield the file list model rows of dirname in lists of `batch` rows
+    (`first` rows for the first list): ".." first, then the non-hidden
+    entries sorted by name.
+
+    Only the names are read up front; each entry is then stat'ed exactly
+    once, through os.scandir when it is available, as its batch is built.
+    """
+    if scandir is not None:
+        entries = sorted((e for e in scandir(dirname) if e.name[0] != '.'), key=lambda e: e.name)
+    else:
+        entries = sorted(f for f in os.listdir(dirname) if f[0] != '.')
+
+    rows = [file_row('..', os.path.dirname(dirname), _stat(os.path.dirname(dirname)))]
+    size = first or batch
+    for entry in entries:
+        if scandir is not None:
+            try:
+                filestat = entry.stat()
+            except OSError:
+                filestat = _stat(entry.path)
+            name, path = entry.name, entry.path
+        else:
+            name, path = entry, os.path.join(dirname, entry)
+            filestat = _stat(path)
+        if filestat is None:
+            # deleted since it was listed
+            continue
+        rows.append(file_row(name, path, filestat))
+        if len(rows) >= size:
+            yield rows
+            rows = []
+            size = batch
+    if rows:
+        yield rows
+
+
+def list_directory(dirname):
+    """Return all the file list model rows of dirname, see iter_directory()."""
+    return [row for rows in iter_directory(dirname) for row in rows]
+
+
 def _wav2array(nchannels, sampwidth, data):
-    """data must be the string containing the bytes from the wav file."""
+    """
+    data must be a string or buffer containing the bytes from the wav file.
+
+    Widths with a NumPy dtype come back as a view of data, 24 bit samples
+    are sign-extended into a new int32 array.
+    """
     num_samples, remainder = divmod(len(data), sampwidth * nchannels)
     if remainder > 0:
         raise ValueError('The length of data is not a multiple of '
                          'sampwidth * num_channels.')
-        if sampwidth > 4:
-            raise ValueError("sampwidth must not be greater than 4.")
+    if sampwidth > 4:
+        raise ValueError("sampwidth must not be greater than 4.")
 
     if sampwidth == 3:
         a = np.empty((num_samples, nchannels, 4), dtype=np.uint8)
-        raw_bytes = np.fromstring(data, dtype=np.uint8)
+        raw_bytes = np.frombuffer(data, dtype=np.uint8)
         a[:, :, :sampwidth] = raw_bytes.reshape(-1, nchannels, sampwidth)
         a[:, :, sampwidth:] = (a[:, :, sampwidth - 1:sampwidth] >> 7) * 255
         result = a.view('<i4').reshape(a.shape[:-1])
     else:
         # 8 bit samples are stored as unsigned ints; others as signed ints.
         dt_char = 'u' if sampwidth == 1 else 'i'
-        a = np.fromstring(data, dtype='<%s%d' % (dt_char, sampwidth))
+        a = np.frombuffer(data, dtype='<%s%d' % (dt_char, sampwidth))
         result = a.reshape(-1, nchannels)
-        return result
+    return result
+
+
+class WavReader(object):
+    """
+    Memory-mapped reader for RIFF/WAVE files.
+
+    Only the header chunks are read; the data chunk is mapped read-only.
+    For 8, 16 and 32 bit integer and 32/64 bit float PCM, `data` is a
+    zero-copy (frames, channels) view of the mapping. 24 bit PCM has no
+    NumPy dtype and is only available through `chunks()`, which converts
+    it one block at a time.
+
+    Raises ValueError for anything that is not uncompressed WAVE.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            riff = f.read(12)
+            if len(riff) < 12 or riff[:4] != 'RIFF' or riff[8:] != 'WAVE':
+                raise ValueError("%s is not a RIFF/WAVE file" % filename)
+            fmt = None
+            data_offset = data_size = None
+            while True:
+                header = f.read(8)
+                if len(header) < 8:
+                    break
+                chunk_id, chunk_size = struct.unpack('<4sI', header)
+                if chunk_id == 'fmt ':
+                    fmt = f.read(chunk_size)
+                elif chunk_id == 'data':
+                    data_offset = f.tell()
+                    data_size = chunk_size
+                    break
+                else:
+                    f.seek(chunk_size, 1)
+                if chunk_size % 2:
+                    f.seek(1, 1)
+            f.seek(0, 2)
+            file_size = f.tell()
+
+        if fmt is None or len(fmt) < 16 or data_offset is None:
+            raise ValueError("%s has no fmt or data chunk" % filename)
+
+        format_tag, self.nchannels, self.rate, _, block_align, bits = struct.unpack('<HHIIHH', fmt[:16])
+        if format_tag == WAVE_FORMAT_EXTENSIBLE and len(fmt) >= 26:
+            format_tag = struct.unpack('<H', fmt[24:26])[0]
+        if format_tag not in (WAVE_FORMAT_PCM, WAVE_FORMAT_IEEE_FLOAT):
+            raise ValueError("%s is a compressed WAVE file (format 0x%04x)" % (filename, format_tag))
+
+        self.sampwidth = (bits + 7) // 8
+        self.is_float = format_tag == WAVE_FORMAT_IEEE_FLOAT
+        if not self.nchannels or block_align != self.sampwidth * self.nchannels:
+            raise ValueError("%s has an inconsistent fmt chunk" % filename)
+        if self.is_float and self.sampwidth not in (4, 8):
+            raise ValueError("%s has unsupported %d bit float samples" % (filename, bits))
+        if self.sampwidth > 4 and not self.is_float:
+            raise ValueError("sampwidth must not be greater than 4.")
+
+        # truncated or still-recording files declare more data than they hold
+        data_size = min(data_size, file_size - data_offset)
+        self.nframes = data_size // block_align
+        self._block_align = block_align
+
+        if self.is_float:
+            self.dtype = np.dtype('<f%d' % self.sampwidth)
+        elif self.sampwidth == 3:
+            self.dtype = None
+        else:
+            self.dtype = np.dtype('<%s%d' % ('u' if self.sampwidth == 1 else 'i', self.sampwidth))
+
+        if self.nframes:
+            self._map = np.memmap(filename, dtype=np.uint8, mode='r', offset=data_offset,
+                                  shape=(self.nframes * block_align,))
+        else:
+            self._map = np.zeros(0, dtype=np.uint8)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._map = None
+
+    @property
+    def duration(self):
+        return float(self.nframes) / self.rate if self.rate else 0.0
+
+    @property
+    def full_scale(self):
+        """(offset, scale) mapping the samples yielded by chunks() to [-1, 1]."""
+        if self.sampwidth == 3:
+            return 0.0, 2.0 ** 23
+        return _full_scale(self.dtype)
+
+    @property
+    def data(self):
+        """Zero-copy (frames, channels) view of the samples."""
+        if self.dtype is None:
+            raise ValueError("24 bit samples can only be read with chunks()")
+        return self._map.view(self.dtype).reshape(-1, self.nchannels)
+
+    def chunks(self, frames=1 << 16, start=0, stop=None):
+        """Yield the samples between frame start and stop, `frames` frames at a time."""
+        stop = self.nframes if stop is None else min(stop, self.nframes)
+        for first in range(start, stop, frames):
+            last = min(first + frames, stop)
+            raw = self._map[first * self._block_align:last * self._block_align]
+            if self.dtype is None:
+                yield _wav2array(self.nchannels, self.sampwidth, raw)
+            else:
+                yield raw.view(self.dtype).reshape(-1, self.nchannels)
+
+    def normalised_chunks(self, frames=1 << 16, start=0, stop=None):
+        """Like chunks(), but as float32 blocks scaled to [-1, 1]."""
+        offset, scale = self.full_scale
+        for block in self.chunks(frames, start, stop):
+            yield _normalise(block, offset, scale)
+
+    def peaks(self, columns, cancelled=None):
+        """
+        Reduce the whole file to `columns` (mins, maxs, rms) peak columns.
+
+        If given, `cancelled` is called between chunks, and None is
+        returned as soon as it returns True.
+        """
+        acc = PeakAccumulator(max(1, -(-self.nframes // max(1, int(columns)))))
+        for block in self.normalised_chunks():
+            if cancelled and cancelled():
+                return None
+            acc.feed(block)
+        return acc.peaks()
+
+    def pyramid(self, cancelled=None):
+        """Like peaks(), but build the PeakPyramid of the whole file."""
+        acc = PeakAccumulator(PeakPyramid.base)
+        for block in self.normalised_chunks():
+            if cancelled and cancelled():
+                return None
+            acc.feed(block)
+        return PeakPyramid.build(acc.peaks(), self.nframes, self.rate)
 
 
 def readwav(file):
@@ -87,24 +341,1816 @@ def readwav(file):
     Read a wav file.
 
     Returns the frame rate, sample width (in bytes) and a numpy array
-    containing the data.
+    containing the data. The array is a memory-mapped view of the file,
+    except for 24 bit files which are converted to int32 in memory.
 
     This function does not read compressed wav files.
     """
-    wav = wave.open(file)
-    rate = wav.getframerate()
-    nchannels = wav.getnchannels()
-    sampwidth = wav.getsampwidth()
-    nframes = wav.getnframes()
-    data = wav.readframes(nframes)
-    wav.close()
-    array = _wav2array(nchannels, sampwidth, data)
-    return rate, sampwidth, array
+    wav = WavReader(file)
+    if wav.dtype is None:
+        array = np.concatenate(list(wav.chunks()) or [np.zeros((0, wav.nchannels), np.int32)])
+    else:
+        array = wav.data
+    return wav.rate, wav.sampwidth, array
+
+
+def _full_scale(dtype):
+    """Return the (offset, scale) pair mapping raw samples of dtype to [-1, 1]."""
+    dtype = np.dtype(dtype)
+    if dtype.kind == 'f':
+        return 0.0, 1.0
+    half = 2.0 ** (8 * dtype.itemsize - 1)
+    if dtype.kind == 'u':
+        return half, half
+    return 0.0, half
+
+
+def _normalise(block, offset, scale):
+    block = np.array(block, dtype=np.float32)
+    if offset:
+        block -= offset
+    if scale != 1.0:
+        block /= scale
+    return block
+
+
+def _reduce_frames(frames, step):
+    """Collapse every `step` rows of a normalised float block into min/max/rms."""
+    ncols = len(frames) // step
+    cols = frames[:ncols * step].reshape(ncols, -1)
+    rms = np.sqrt(np.mean(np.square(cols), axis=1))
+    return cols.min(axis=1), cols.max(axis=1), rms
+
+
+class PeakAccumulator(object):
+    """
+    Incrementally reduce normalised (frames, channels) float blocks to peak
+    columns of `step` frames each, all channels mixed together.
+
+    Only the finished columns and less than one column of pending frames
+    are kept, so blocks can be streamed in from a file of any length.
+    """
+
+    def __init__(self, step):
+        self.step = int(step)
+        self._columns = []
+        self._carry = None
+
+    def feed(self, block):
+        if block.ndim == 1:
+            block = block.reshape(-1, 1)
+        if self._carry is not None:
+            block = np.concatenate([self._carry, block])
+            self._carry = None
+        full = (len(block) // self.step) * self.step
+        if full:
+            self._columns.append(_reduce_frames(block[:full], self.step))
+            if len(self._columns) > 64:
+                self._columns = [self._concat(self._columns)]
+        if full < len(block):
+            self._carry = block[full:].copy()
+
+    def peaks(self):
+        """Return the (mins, maxs, rms) columns so far, the pending frames as a last partial column."""
+        parts = list(self._columns)
+        if self._carry is not None:
+            parts.append(_reduce_frames(self._carry, len(self._carry)))
+        if not parts:
+            empty = np.zeros(0, dtype=np.float32)
+            return empty, empty, empty
+        return self._concat(parts)
+
+    @staticmethod
+    def _concat(parts):
+        return tuple(np.concatenate([p[i] for p in parts]).astype(np.float32) for i in range(3))
+
+
+def resample_peaks(peaks, width):
+    """Reduce (mins, maxs, rms) peak columns further, down to `width` columns."""
+    n = len(peaks[0])
+    if n <= width:
+        return peaks
+    return _merge_columns(peaks, np.arange(int(width)) * n // int(width))
+
+
+def _decimate(peaks, step):
+    """Merge every `step` consecutive (mins, maxs, rms) peak columns into one."""
+    return _merge_columns(peaks, np.arange(0, len(peaks[0]), step))
+
+
+def _merge_columns(peaks, idx):
+    """Merge the (mins, maxs, rms) peak columns from each index of idx up to the next."""
+    mins, maxs, rms = peaks
+    counts = np.diff(np.append(idx, len(mins)))
+    return (np.minimum.reduceat(mins, idx),
+            np.maximum.reduceat(maxs, idx),
+            np.sqrt(np.add.reduceat(np.square(rms), idx) / counts).astype(np.float32))
+
+
+class PeakPyramid(object):
+    """
+    Multi-resolution peaks of one file.
+
+    Level 0 has a (min, max, rms) column for every `base` frames, and
+    every next level merges `factor` columns of the previous one, up to a
+    level of at most `top` columns. A view of any range of the file at
+    any width only reads the columns of the coarsest level that still
+    has one column per pixel, so drawing costs the same from the whole
+    file down to a few hundred samples; below that, view() returns None
+    and the caller reads the samples themselves.
+    """
+
+    base = 256
+    factor = 4
+
+    def __init__(self, levels, nframes, rate=0):
+        self.levels = levels
+        self.nframes = nframes
+        self.rate = rate
+
+    @classmethod
+    def build(cls, level0, nframes, rate=0, top=1024):
+        levels = [level0]
+        while len(levels[-1][0]) > top:
+            levels.append(_decimate(levels[-1], cls.factor))
+        return cls(levels, nframes, rate)
+
+    @classmethod
+    def from_samples(cls, samples, rate=0):
+        """Build the pyramid of normalised float (frames, channels) samples."""
+        acc = PeakAccumulator(cls.base)
+        acc.feed(samples)
+        return cls.build(acc.peaks(), len(samples), rate)
+
+    def frames_per_column(self, level):
+        return self.base * self.factor ** level
+
+    def view(self, start, stop, width, level=None):
+        """
+        Return the (mins, maxs, rms) columns of frames start to stop in at
+        most `width` columns, or None if that range needs more detail
+        than level 0 holds. Columns not computed yet read as silence.
+        """
+        frames_per_pixel = float(stop - start) / max(1, width)
+        if level is None:
+            if frames_per_pixel < self.base:
+                return None
+            level = 0
+            while level + 1 < len(self.levels) and self.frames_per_column(level + 1) <= frames_per_pixel:
+                level += 1
+        step = self.frames_per_column(level)
+        first, last = int(start) // step, -(-int(stop) // step)
+        columns = []
+        for array in self.levels[level]:
+            part = array[first:last]
+            if len(part) < last - first:
+                part = np.concatenate([part, np.zeros(last - first - len(part), np.float32)])
+            columns.append(part)
+        return resample_peaks(tuple(columns), width)
+
+    def arrays(self):
+        """Flatten to named arrays for np.savez, see from_arrays()."""
+        arrays = {"info": np.array([self.nframes, self.rate, self.base, self.factor, len(self.levels)], dtype=np.int64)}
+        for n, level in enumerate(self.levels):
+            for name, array in zip(("mins", "maxs", "rms"), level):
+                arrays["%s_%d" % (name, n)] = array
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        nframes, rate, base, factor, nlevels = [int(v) for v in arrays["info"]]
+        if (base, factor) != (cls.base, cls.factor):
+            raise ValueError("peak pyramid layout changed")
+        levels = [tuple(arrays["%s_%d" % (name, n)] for name in ("mins", "maxs", "rms")) for n in range(nlevels)]
+        return cls(levels, nframes, rate)
+
+
+def spectrogram_layout(nframes, columns, nfft=1024):
+    """
+    Pick the (hop, step) of a spectrogram of nframes frames: FFT frames
+    start every `hop` samples (never less than nfft / 2, more for long
+    files so there are at most 8 per column) and every `step` of them are
+    averaged into one of at most `columns` columns.
+    """
+    hop = max(nfft // 2, nframes // (columns * 8))
+    fft_frames = max(1, (nframes - nfft) // hop + 1)
+    return hop, max(1, -(-fft_frames // columns))
+
+
+class SpectrogramAccumulator(object):
+    """
+    Streaming short-time Fourier transform of normalised blocks, channels
+    mixed to mono.
+
+    Each block is cut into Hann-windowed frames of `nfft` samples, `hop`
+    apart, with a strided view, all transformed in one batched rfft. The
+    power of every `step` consecutive frames is averaged into one column.
+    Memory use depends on the number of columns, not on the file length.
+    """
+
+    def __init__(self, hop, step, nfft=1024):
+        self.hop = int(hop)
+        self.step = int(step)
+        self.nfft = nfft
+        self.window = np.hanning(nfft).astype(np.float32)
+        self._buffer = np.zeros(0, dtype=np.float32)
+        self._skip = 0
+        self._columns = []
+        self._sum = np.zeros(nfft // 2 + 1, dtype=np.float64)
+        self._count = 0
+
+    def feed(self, block):
+        mono = block.mean(axis=1) if block.ndim == 2 else block
+        if self._skip:
+            drop = min(self._skip, len(mono))
+            mono = mono[drop:]
+            self._skip -= drop
+        buf = np.concatenate([self._buffer, mono.astype(np.float32)])
+        nframes = (len(buf) - self.nfft) // self.hop + 1 if len(buf) >= self.nfft else 0
+        if nframes > 0:
+            frames = as_strided(buf, shape=(nframes, self.nfft), strides=(self.hop * buf.itemsize, buf.itemsize))
+            self._add(np.square(np.abs(np.fft.rfft(frames * self.window, axis=1))))
+            consumed = nframes * self.hop
+            # with hops longer than a frame, the next one may start beyond this block
+            self._skip = max(0, consumed - len(buf))
+            buf = buf[consumed:]
+        self._buffer = buf.copy()
+
+    def _add(self, power):
+        if self._count:
+            take = min(self.step - self._count, len(power))
+            self._sum += power[:take].sum(axis=0)
+            self._count += take
+            power = power[take:]
+            if self._count == self.step:
+                self._columns.append((self._sum / self.step)[np.newaxis])
+                self._sum = np.zeros_like(self._sum)
+                self._count = 0
+        full = (len(power) // self.step) * self.step
+        if full:
+            self._columns.append(power[:full].reshape(-1, self.step, power.shape[1]).mean(axis=1))
+        if full < len(power):
+            self._sum += power[full:].sum(axis=0)
+            self._count = len(power) - full
+
+    def spectrogram(self, columns=None, bands=128, floor=-90.0):
+        """
+        Return the spectrogram as a (bands, columns) uint8 image, low
+        frequencies first: frequency bins grouped into log-spaced bands,
+        levels mapped from `floor` dBFS (0) to 0 dBFS (255). If there are
+        more than `columns` columns they are averaged down.
+        """
+        parts = list(self._columns)
+        if self._count:
+            parts.append((self._sum / self._count)[np.newaxis])
+        if not parts:
+            return np.zeros((0, 0), dtype=np.uint8)
+        power = np.concatenate(parts)
+        if columns and len(power) > columns:
+            idx = np.arange(0, len(power), -(-len(power) // columns))
+            power = np.add.reduceat(power, idx, axis=0) / np.diff(np.append(idx, len(power)))[:, np.newaxis]
+        edges = np.unique(np.logspace(0, np.log10(power.shape[1]), bands + 1).astype(int)) - 1
+        power = np.add.reduceat(power, edges[:-1], axis=1) / np.diff(edges)
+        # a full scale sine peaks at (window sum / 2) squared
+        reference = 20 * np.log10(self.window.sum() / 2)
+        levels = 10 * np.log10(power + 1e-20) - reference
+        image = np.clip((levels - floor) * (255.0 / -floor), 0, 255).astype(np.uint8)
+        return np.ascontiguousarray(image.T)
+
+
+class PeakCache(object):
+    """
+    On-disk store of precomputed waveform peaks and spectrograms.
+
+    There is one compressed .npz entry per audio file and kind of data,
+    named after a hash of its path. The size and mtime of the source file are recorded in the
+    entry and checked on every lookup, so an edited file is a miss and its
+    stale entry is dropped. Once the entries exceed `budget` bytes, the
+    least recently used ones are evicted down to 90% of it (a hit touches
+    the entry's mtime).
+    The size of the cache is kept as a running total, only checked against
+    the directory every `rescan_every` stores or when it goes over budget,
+    so storing does not scan the directory every time.
+
+    The budget defaults to $BNP_PEAK_CACHE_MB megabytes (256).
+    """
+
+    version = 2
+    rescan_every = 1024
+
+    def __init__(self, directory=None, budget=None):
+        self.directory = directory or os.path.join(cache_dir, "peaks")
+        if budget is None:
+            budget = int(os.environ.get("BNP_PEAK_CACHE_MB", 256)) * 1024 * 1024
+        self.budget = budget
+        self._lock = threading.Lock()
+        # bytes in the directory as of the last scan, plus what was stored since
+        self._size = None
+        self._saves = 0
+
+    kinds = ("peaks", "spectrogram", "tempo")
+
+    def _entry(self, filename, kind="peaks"):
+        key = hashlib.sha1(os.path.abspath(filename)).hexdigest()
+        if kind != "peaks":
+            key += "." + kind
+        return os.path.join(self.directory, key + ".npz")
+
+    def _meta(self, filename):
+        filestat = os.stat(filename)
+        return np.array([self.version, filestat.st_size, filestat.st_mtime], dtype=np.float64)
+
+    def get(self, filename):
+        """Return the cached PeakPyramid of filename, or None."""
+        arrays = self._load(filename, "peaks")
+        return arrays and PeakPyramid.from_arrays(arrays)
+
+    def get_spectrogram(self, filename):
+        """Return the cached spectrogram image of filename, or None."""
+        arrays = self._load(filename, "spectrogram")
+        return arrays and arrays["image"]
+
+    def put(self, filename, peaks):
+        """Store the PeakPyramid of filename, then evict down to the budget."""
+        self._save(filename, "peaks", **peaks.arrays())
+
+    def put_spectrogram(self, filename, image):
+        """Store the spectrogram image of filename, then evict down to the budget."""
+        self._save(filename, "spectrogram", image=image)
+
+    def get_tempo(self, filename):
+        """Return the cached (bpm, onset times) of filename, or None."""
+        arrays = self._load(filename, "tempo")
+        return arrays and (float(arrays["bpm"]), arrays["onsets"])
+
+    def put_tempo(self, filename, bpm, onsets):
+        """Store the tempo and onset times of filename, then evict down to the budget."""
+        self._save(filename, "tempo", bpm=np.array(bpm), onsets=onsets)
+
+    def _load(self, filename, kind):
+        entry = self._entry(filename, kind)
+        try:
+            meta = self._meta(filename)
+        except OSError:
+            return None
+        fresh = False
+        try:
+            npz = np.load(entry)
+            try:
+                if np.array_equal(npz["meta"], meta):
+                    arrays = dict((name, npz[name]) for name in npz.files if name not in ("meta", "path"))
+                    fresh = True
+            finally:
+                npz.close()
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return None
+        except Exception:
+            # truncated or otherwise unreadable: a miss, and the entry goes
+            pass
+        if not fresh:
+            self._remove(entry)
+            return None
+        try:
+            os.utime(entry, None)
+        except OSError:
+            pass
+        return arrays
+
+    def _save(self, filename, kind, **arrays):
+        entry = self._entry(filename, kind)
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            tmp = entry[:-4] + ".%d.%d.tmp.npz" % (os.getpid(), threading.current_thread().ident)
+            np.savez_compressed(tmp, meta=self._meta(filename), path=np.array(os.path.abspath(filename)),
+                                **arrays)
+            size = os.path.getsize(tmp)
+            try:
+                size -= os.path.getsize(entry)
+            except OSError:
+                pass
+            os.rename(tmp, entry)
+        except (IOError, OSError) as e:
+            print "Could not cache", kind, "of", filename, ":", e
+            return
+        with self._lock:
+            self._saves += 1
+            if self._size is not None and self._saves % self.rescan_every:
+                self._size += size
+                if self._size <= self.budget:
+                    return
+        self.evict()
+
+    def invalidate(self, filename):
+        """Drop the entries of filename, if any."""
+        for kind in self.kinds:
+            self._remove(self._entry(filename, kind))
+
+    def purge_stale(self):
+        """Drop every entry whose source file has changed or disappeared."""
+        for entry in self._entries():
+            try:
+                npz = np.load(entry)
+                try:
+                    source = str(npz["path"])
+                    meta = npz["meta"]
+                finally:
+                    npz.close()
+                stale = not np.array_equal(meta, self._meta(source))
+            except Exception:
+                stale = True
+            if stale:
+                self._remove(entry)
+
+    def evict(self, low_water=0.9):
+        """
+        If the cache is over its budget, remove least recently used entries
+        until it fits in `low_water` of it.
+        """
+        entries = []
+        total = 0
+        for entry in self._entries():
+            try:
+                entrystat = os.stat(entry)
+            except OSError:
+                continue
+            entries.append((entrystat.st_mtime, entrystat.st_size, entry))
+            total += entrystat.st_size
+        entries.sort()
+        limit = self.budget * low_water if total > self.budget else self.budget
+        while total > limit and entries:
+            mtime, size, entry = entries.pop(0)
+            self._remove(entry)
+            total -= size
+        with self._lock:
+            self._size = total
+
+    def _entries(self):
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return []
+        return [os.path.join(self.directory, n) for n in names if n.endswith(".npz") and ".tmp." not in n]
+
+    def _remove(self, entry):
+        try:
+            os.remove(entry)
+        except OSError:
+            pass
+
+
+def decode_chunks(filename, info=None, cancelled=None):
+    """
+    Decode any file GStreamer can read and yield its samples as float32
+    (frames, channels) blocks in [-1, 1].
+
+    The decodebin2 ! audioconvert ! appsink pipeline is not synchronised
+    to the clock, so it runs as fast as the decoder allows, and at most a
+    handful of buffers are queued between it and the caller. If given,
+    `info` is filled with the "rate", "channels" and (if known) "duration"
+    of the stream before the first block is yielded. Raises ValueError
+    when the file can not be decoded.
+    """
+    queue = Queue.Queue(maxsize=16)
+    done = threading.Event()
+    pipeline = gst.parse_launch(
+        "filesrc name=src ! decodebin2 ! audioconvert"
+        " ! audio/x-raw-float, width=(int)32, endianness=(int)1234"
+        " ! appsink name=sink sync=false emit-signals=true")
+    pipeline.get_by_name("src").set_property("location", filename)
+
+    def put(item):
+        # never block the streaming thread once the consumer is gone
+        while not done.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return
+            except Queue.Full:
+                pass
+
+    def on_buffer(sink):
+        buf = sink.emit("pull-buffer")
+        structure = buf.get_caps()[0]
+        put((structure["rate"], structure["channels"], buf.data))
+        return gst.FLOW_OK
+
+    def on_message(bus, message):
+        if message.type == gst.MESSAGE_EOS:
+            put(None)
+        elif message.type == gst.MESSAGE_ERROR:
+            put(ValueError("%s: %s" % (filename, message.parse_error()[0].message)))
+        return gst.BUS_PASS
+
+    pipeline.get_by_name("sink").connect("new-buffer", on_buffer)
+    pipeline.get_bus().set_sync_handler(on_message)
+    pipeline.set_state(gst.STATE_PLAYING)
+    first = True
+    try:
+        while not (cancelled and cancelled()):
+            try:
+                item = queue.get(timeout=0.1)
+            except Queue.Empty:
+                continue
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            rate, channels, data = item
+            if first and info is not None:
+                info["rate"], info["channels"] = rate, channels
+                try:
+                    info["duration"] = float(pipeline.query_duration(gst.FORMAT_TIME)[0]) / gst.SECOND
+                except gst.QueryError:
+                    pass
+            first = False
+            yield np.frombuffer(data, dtype='<f4').reshape(-1, channels)
+    finally:
+        done.set()
+        pipeline.set_state(gst.STATE_NULL)
+
+
+def decode_pyramid(filename, cancelled=None, progress=None):
+    """
+    Build the PeakPyramid of a compressed file through decode_chunks().
+
+    If given, `progress` is called a few times a second with the pyramid
+    of what has been decoded so far (the rest of the file reads as
+    silence). Returns None if cancelled.
+    """
+    info = {}
+    acc = PeakAccumulator(PeakPyramid.base)
+    frames = 0
+    last = time.time()
+    for block in decode_chunks(filename, info, cancelled):
+        acc.feed(block)
+        frames += len(block)
+        if progress and time.time() - last > 0.25:
+            last = time.time()
+            total = max(frames, int(info.get("duration", 0) * info["rate"]))
+            progress(PeakPyramid.build(acc.peaks(), total, info["rate"]))
+    if cancelled and cancelled():
+        return None
+    if not frames:
+        raise ValueError("%s has no audio" % filename)
+    return PeakPyramid.build(acc.peaks(), frames, info["rate"])
+
+
+def load_peaks(filename, peak_cache, cancelled=None, progress=None):
+    """
+    Return the PeakPyramid of an audio file from peak_cache, computing and
+    storing it on a miss: WAV files are read directly, anything else is
+    decoded through GStreamer (with progress reports, see decode_pyramid()).
+    """
+    peaks = peak_cache.get(filename)
+    if peaks is None:
+        try:
+            with WavReader(filename) as wav:
+                peaks = wav.pyramid(cancelled)
+        except ValueError:
+            peaks = decode_pyramid(filename, cancelled, progress)
+        if peaks is not None:
+            peak_cache.put(filename, peaks)
+    return peaks
+
+
+def load_samples(filename, max_duration, cancelled=None):
+    """
+    Decode a whole file to float32 (frames, channels) samples in [-1, 1].
+
+    Returns a (samples, rate) pair, or None if the file is longer than
+    max_duration seconds (given up as soon as that is known) or the job
+    was cancelled.
+    """
+    blocks = []
+    try:
+        wav = WavReader(filename)
+    except ValueError:
+        wav = None
+    if wav is not None:
+        with wav:
+            if wav.duration > max_duration:
+                return None
+            rate = wav.rate
+            blocks = list(wav.normalised_chunks())
+    else:
+        info = {}
+        frames = 0
+        for block in decode_chunks(filename, info, cancelled):
+            frames += len(block)
+            if info.get("duration", 0) > max_duration or frames > max_duration * info["rate"]:
+                return None
+            blocks.append(block)
+        rate = info.get("rate")
+    if not blocks or (cancelled and cancelled()):
+        return None
+    return np.concatenate(blocks), rate
+
+
+CachedSample = namedtuple("CachedSample", "data rate channels nframes peaks")
+
+
+class SampleCache(object):
+    """
+    Byte-budgeted LRU of decoded one-shots kept in RAM.
+
+    Entries hold the interleaved float32 PCM of files no longer than
+    `max_duration` seconds, with their peaks, keyed by path and mtime.
+    `hits` and `misses` count the lookups made through get(); stats()
+    sums them up. It is shared by the waveform worker and the main loop,
+    hence the lock.
+
+    The budget defaults to $BNP_SAMPLE_CACHE_MB megabytes (128).
+    """
+
+    def __init__(self, budget=None, max_duration=10):
+        if budget is None:
+            budget = int(os.environ.get("BNP_SAMPLE_CACHE_MB", 128)) * 1024 * 1024
+        self.budget = budget
+        self.max_duration = max_duration
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _key(self, filename):
+        return os.path.abspath(filename), os.stat(filename).st_mtime
+
+    def get(self, filename, count=True):
+        """Return the CachedSample of filename, or None."""
+        try:
+            key = self._key(filename)
+        except OSError:
+            return None
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry
+            if count:
+                if entry is None:
+                    self.misses += 1
+                else:
+                    self.hits += 1
+        return entry
+
+    def put(self, filename, samples, rate, peaks):
+        data = samples.astype('<f4').tostring()
+        if len(data) > self.budget:
+            return
+        try:
+            key = self._key(filename)
+        except OSError:
+            return
+        entry = CachedSample(data, rate, samples.shape[1], samples.shape[0], peaks)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old.data)
+            self._entries[key] = entry
+            self.size += len(data)
+            while self.size > self.budget:
+                key, old = self._entries.popitem(last=False)
+                self.size -= len(old.data)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": float(self.hits) / lookups if lookups else 0.0,
+                "entries": len(self._entries),
+                "bytes": self.size,
+            }
+
+
+class MemoryPlayer(object):
+    """
+    Plays a CachedSample from RAM through appsrc ! audioconvert !
+    audioresample ! autoaudiosink, so retriggering a cached one-shot
+    touches neither the disk nor a decoder. `pipeline` is the element to
+    drive (states, queries, seeks) like a playbin.
+    """
+
+    def __init__(self):
+        self.pipeline = gst.parse_launch(
+            "appsrc name=src format=time stream-type=seekable"
+            " ! audioconvert ! audioresample ! autoaudiosink name=sink")
+        self.src = self.pipeline.get_by_name("src")
+        self.src.connect("need-data", self._on_need_data)
+        self.src.connect("seek-data", self._on_seek_data)
+        self._entry = None
+        self._offset = 0
+
+    def load(self, entry):
+        self.pipeline.set_state(gst.STATE_READY)
+        self._entry = entry
+        self._offset = 0
+        self.src.set_property("caps", gst.Caps(
+            "audio/x-raw-float, width=(int)32, endianness=(int)1234, rate=(int)%d, channels=(int)%d"
+            % (entry.rate, entry.channels)))
+
+    @property
+    def duration(self):
+        """Length of the loaded sample in nanoseconds (appsrc can not always answer the query)."""
+        if self._entry is None:
+            return 0
+        return self._entry.nframes * gst.SECOND // self._entry.rate
+
+    def _on_need_data(self, src, length):
+        entry, offset = self._entry, self._offset
+        if entry is None or offset >= entry.nframes:
+            src.emit("end-of-stream")
+            return
+        frame_size = 4 * entry.channels
+        buf = gst.Buffer(entry.data[offset * frame_size:])
+        buf.timestamp = offset * gst.SECOND // entry.rate
+        buf.duration = (entry.nframes - offset) * gst.SECOND // entry.rate
+        self._offset = entry.nframes
+        src.emit("push-buffer", buf)
+
+    def _on_seek_data(self, src, offset):
+        if self._entry is not None:
+            self._offset = int(offset * self._entry.rate // gst.SECOND)
+        return True
+
+
+def load_spectrogram(filename, peak_cache, cancelled=None):
+    """
+    Return the spectrogram image of an audio file (see
+    SpectrogramAccumulator.spectrogram()) from peak_cache, computing and
+    storing it on a miss. Returns None if cancelled.
+    """
+    image = peak_cache.get_spectrogram(filename)
+    if image is not None:
+        return image
+    acc = None
+    try:
+        wav = WavReader(filename)
+    except ValueError:
+        wav = None
+    if wav is not None:
+        with wav:
+            acc = SpectrogramAccumulator(*spectrogram_layout(wav.nframes, SPECTROGRAM_COLUMNS))
+            for block in wav.normalised_chunks():
+                if cancelled and cancelled():
+                    return None
+                acc.feed(block)
+    else:
+        info = {}
+        for block in decode_chunks(filename, info, cancelled):
+            if acc is None:
+                # without a known length, keep 16 frames per column and average down at the end
+                nframes = int(info.get("duration", 0) * info["rate"])
+                acc = SpectrogramAccumulator(*(spectrogram_layout(nframes, SPECTROGRAM_COLUMNS) if nframes else (512, 16)))
+            acc.feed(block)
+        if cancelled and cancelled():
+            return None
+        if acc is None:
+            raise ValueError("%s has no audio" % filename)
+    image = acc.spectrogram(SPECTROGRAM_COLUMNS)
+    peak_cache.put_spectrogram(filename, image)
+    return image
+
+
+class OnsetEnvelope(object):
+    """
+    Streaming spectral flux: feed() normalised (frames, channels) blocks
+    of any size, and `flux` holds, for every hop of about 12 ms, how much
+    the log magnitude spectrum grew since the previous one (silence before
+    the first). Flux value n is centred on time n / frame_rate + offset.
+    """
+
+    def __init__(self, rate):
+        self.nfft = 1 << int(round(np.log2(rate * 0.023)))
+        self.hop = self.nfft // 2
+        self.frame_rate = float(rate) / self.hop
+        self.offset = self.nfft / 2.0 / rate
+        self.window = np.hanning(self.nfft).astype(np.float32)
+        self._tail = np.zeros(0, dtype=np.float32)
+        self._last = None
+        self._flux = []
+
+    def feed(self, block):
+        mono = np.concatenate([self._tail, block.mean(axis=1, dtype=np.float32)])
+        count = (len(mono) - self.nfft) // self.hop + 1
+        if count <= 0:
+            self._tail = mono
+            return
+        frames = as_strided(mono, (count, self.nfft), (self.hop * mono.itemsize, mono.itemsize))
+        for first in range(0, count, 256):
+            spectrum = np.log1p(100 * np.abs(np.fft.rfft(frames[first:first + 256] * self.window)))
+            previous = np.zeros_like(spectrum[:1]) if self._last is None else self._last
+            growth = np.diff(np.vstack([previous, spectrum]), axis=0)
+            self._flux.append(np.maximum(growth, 0).sum(axis=1))
+            self._last = spectrum[-1:]
+        self._tail = mono[count * self.hop:]
+
+    @property
+    def flux(self):
+        return np.concatenate(self._flux) if self._flux else np.zeros(0)
+
+
+def pick_onsets(flux, frame_rate, spacing=0.05):
+    """
+    Return the times (s) of the peaks of flux, at least `spacing` s apart,
+    that stand out of the median of the surrounding 0.4 s.
+    """
+    if len(flux) < 3 or not flux.max():
+        return np.zeros(0)
+
+    def windows(reach):
+        padded = np.concatenate([np.zeros(reach), flux, np.zeros(reach)])
+        return as_strided(padded, (len(flux), 2 * reach + 1), (padded.itemsize, padded.itemsize))
+
+    threshold = np.median(windows(int(0.2 * frame_rate)), axis=1) + 0.05 * flux.max()
+    peaks = np.flatnonzero((flux == windows(max(1, int(spacing * frame_rate))).max(axis=1)) & (flux > threshold))
+    return peaks / frame_rate
+
+
+def estimate_tempo(flux, frame_rate, duration=None, low=60, high=180):
+    """
+    Return the tempo (BPM) at which flux repeats best, from its
+    autocorrelation, or 0.0 if there is no clear beat.
+
+    Loops lasting a whole number of bars (of 4 beats) at about that tempo
+    get the exact tempo of their length.
+    """
+    if len(flux) < 2 * frame_rate * 60 / high:
+        return 0.0
+    x = flux - flux.mean()
+    power = np.square(np.abs(np.fft.rfft(x, 2 * len(x))))
+    correlation = np.fft.irfft(power)[:len(x)]
+    lags = np.arange(int(frame_rate * 60 / high), min(int(frame_rate * 60 / low) + 1, len(x) - 1))
+    if not len(lags) or correlation[0] <= 0:
+        return 0.0
+    # mildly prefer tempos around 120 BPM over their halves and doubles
+    weight = np.exp(-0.5 * np.square(np.log2(frame_rate * 60.0 / lags / 120)))
+    lag = lags[np.argmax(correlation[lags] * weight)]
+    if correlation[lag] <= 0:
+        return 0.0
+    before, at, after = correlation[lag - 1:lag + 2]
+    curvature = before - 2 * at + after
+    bpm = frame_rate * 60.0 / (lag + (0.5 * (before - after) / curvature if curvature < 0 else 0))
+    if duration:
+        beats = duration * bpm / 60
+        bars = round(beats / 4)
+        if bars >= 1 and abs(beats - 4 * bars) < 0.25:
+            bpm = 4 * bars * 60 / duration
+    return round(bpm, 1)
+
+
+_tempo_cache = None
+
+
+def tempo_of(filename, peak_cache=None):
+    """
+    Return (filename, bpm, onset times) of an audio file from peak_cache
+    (by default, the one in cache_dir), analysing and storing it on a
+    miss. bpm is 0.0 when there is no clear beat, None if the file can
+    not be read.
+    """
+    global _tempo_cache
+    if peak_cache is None:
+        # one per process, for its running size total
+        _tempo_cache = peak_cache = _tempo_cache or PeakCache()
+    cached = peak_cache.get_tempo(filename)
+    if cached is not None:
+        return (filename,) + cached
+    try:
+        try:
+            wav = WavReader(filename)
+        except ValueError:
+            wav = None
+        if wav is not None:
+            with wav:
+                envelope = OnsetEnvelope(wav.rate)
+                for block in wav.normalised_chunks():
+                    envelope.feed(block)
+                duration = wav.duration
+        else:
+            info = {}
+            envelope = None
+            frames = 0
+            for block in decode_chunks(filename, info):
+                envelope = envelope or OnsetEnvelope(info["rate"])
+                envelope.feed(block)
+                frames += len(block)
+            if envelope is None:
+                raise ValueError("%s has no audio" % filename)
+            duration = float(frames) / info["rate"]
+    except (IOError, OSError, ValueError):
+        return filename, None, np.zeros(0)
+    flux = envelope.flux
+    bpm = estimate_tempo(flux, envelope.frame_rate, duration)
+    onsets = pick_onsets(flux, envelope.frame_rate) + envelope.offset
+    peak_cache.put_tempo(filename, bpm, onsets)
+    return filename, bpm, onsets
+
+
+class WaveformWorker(threading.Thread):
+    """
+    Computes waveform peaks away from the GTK main loop.
+
+    Only the latest request matters: submitting a file supersedes the
+    queued job, and a running one notices it between chunks and gives up.
+    Results reach callback(filename, peaks) in the main loop through
+    gobject.idle_add; peaks is None when the file can not be drawn.
+    Files that have to be decoded report partial peaks along the way, so
+    the callback can be called several times for the same file.
+
+    With a `sample_cache`, short files are decoded whole and kept there
+    along with their peaks, ready for MemoryPlayer. With `latency`, the
+    time each job takes is recorded in that LatencyStats as a span named
+    after its kind.
+    """
+
+    def __init__(self, peak_cache, sample_cache=None, latency=None):
+        threading.Thread.__init__(self, name="waveform-worker")
+        self.daemon = True
+        self.peak_cache = peak_cache
+        self.sample_cache = sample_cache
+        self.latency = latency
+        self._cond = threading.Condition()
+        self._job = None
+        self._generation = 0
+
+    def submit(self, filename, callback, kind="waveform"):
+        """Compute the peaks of filename, or its spectrogram image if kind is "spectrogram"."""
+        with self._cond:
+            self._generation += 1
+            self._job = (self._generation, filename, callback, kind)
+            self._cond.notify()
+
+    def cancel(self):
+        with self._cond:
+            self._generation += 1
+            self._job = None
+
+    def run(self):
+        while True:
+            with self._cond:
+                while self._job is None:
+                    self._cond.wait()
+                generation, filename, callback, kind = self._job
+                self._job = None
+
+            cancelled = lambda: generation != self._generation
+            progress = lambda peaks: gobject.idle_add(self._deliver, generation, filename, callback, peaks)
+            start = time.time()
+            try:
+                if kind == "spectrogram":
+                    peaks = load_spectrogram(filename, self.peak_cache, cancelled)
+                else:
+                    peaks = self.load(filename, cancelled, progress)
+            except IOError as e:
+                print "I/O error({0}): {1}".format(e.errno, e.strerror)
+                peaks = None
+            except ValueError:
+                print "Error opening file for plotting: Will not draw waveform."
+                peaks = None
+            except Exception as e:
+                # whatever it is, the worker must survive it
+                print "Could not draw", filename, ":", e
+                peaks = None
+            if not cancelled():
+                if self.latency:
+                    self.latency.record(kind, time.time() - start)
+                gobject.idle_add(self._deliver, generation, filename, callback, peaks)
+
+    def load(self, filename, cancelled, progress):
+        if self.sample_cache is None:
+            return load_peaks(filename, self.peak_cache, cancelled, progress)
+        entry = self.sample_cache.get(filename, count=False)
+        if entry is not None:
+            return entry.peaks
+        loaded = load_samples(filename, self.sample_cache.max_duration, cancelled)
+        if loaded is None:
+            return load_peaks(filename, self.peak_cache, cancelled, progress)
+        samples, rate = loaded
+        peaks = self.peak_cache.get(filename)
+        if peaks is None:
+            peaks = PeakPyramid.from_samples(samples, rate)
+            self.peak_cache.put(filename, peaks)
+        self.sample_cache.put(filename, samples, rate, peaks)
+        return peaks
+
+    def _deliver(self, generation, filename, callback, peaks):
+        if generation == self._generation:
+            callback(filename, peaks)
+        return False
+
+
+def thumbnail_pixels(peaks, width, height, color=(255, 69, 0), rms_color=(139, 0, 0)):
+    """Draw a PeakPyramid as a (height, width, 4) RGBA array, transparent around the waveform."""
+    columns = peaks.view(0, peaks.nframes, width)
+    if columns is None:
+        columns = peaks.view(0, peaks.nframes, width, level=0)
+    mins, maxs, rms = columns
+    pixels = np.zeros((height, width, 4), dtype=np.uint8)
+    if not len(mins):
+        return pixels
+    # stretch files with fewer columns than pixels
+    index = np.arange(width) * len(mins) // width
+    mins, maxs, rms = mins[index], maxs[index], rms[index]
+    scale = (height / 2.0) / max(float(max(maxs.max(), -mins.min())), 1e-6)
+    mid = (height - 1) / 2.0
+    y = np.arange(height)[:, None]
+    pixels[(y >= mid - maxs * scale - 0.5) & (y <= mid - mins * scale + 0.5)] = color + (255,)
+    pixels[np.abs(y - mid) <= rms * scale] = rms_color + (255,)
+    return pixels
+
+
+class ThumbnailService(object):
+    """
+    Renders tiny waveforms of audio files with a few background threads,
+    into a cache of the latest `size` pixbufs.
+
+    request() replaces the files waiting to be rendered, so that only
+    those in (or about to scroll into) view get done, in the order given.
+    on_ready() is called from the main loop whenever thumbnails are added.
+    """
+
+    width = 64
+    height = 20
+
+    def __init__(self, peak_cache, on_ready, threads=2, size=4096):
+        self.peak_cache = peak_cache
+        self.on_ready = on_ready
+        self.size = size
+        self.cache = OrderedDict()
+        self._cond = threading.Condition()
+        self._pending = []
+        self._running = set()
+        for n in range(threads):
+            thread = threading.Thread(target=self._run, name="thumbnails-%d" % n)
+            thread.daemon = True
+            thread.start()
+
+    def get(self, filename, mtime):
+        """Return the thumbnail of filename, or None if not rendered (yet)."""
+        with self._cond:
+            pixbuf = self.cache.pop((filename, mtime), None)
+            if pixbuf is not None:
+                self.cache[(filename, mtime)] = pixbuf
+        return pixbuf or None
+
+    def request(self, files):
+        """Render these (filename, mtime) pairs, and only them, first ones first."""
+        with self._cond:
+            self._pending = [key for key in files if key not in self.cache and key not in self._running]
+            self._pending.reverse()
+            self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                key = self._pending.pop()
+                self._running.add(key)
+            try:
+                pixels = thumbnail_pixels(load_peaks(key[0], self.peak_cache), self.width, self.height)
+            except Exception as e:
+                if not isinstance(e, (IOError, ValueError)):
+                    print "Could not draw a thumbnail of", key[0], ":", e
+                # not retried until the file changes
+                pixels = None
+            gobject.idle_add(self._deliver, key, pixels)
+
+    def _deliver(self, key, pixels):
+        if pixels is None:
+            pixbuf = False
+        else:
+            pixbuf = gtk.gdk.pixbuf_new_from_data(pixels.tostring(), gtk.gdk.COLORSPACE_RGB, True, 8,
+                                                  self.width, self.height, self.width * 4)
+        with self._cond:
+            self._running.discard(key)
+            self.cache[key] = pixbuf
+            while len(self.cache) > self.size:
+                self.cache.popitem(last=False)
+        self.on_ready()
+        return False
+
+
+class TempoService(object):
+    """
+    Runs tempo_of() over audio files with a pool of `jobs` processes (by
+    default, one per core but one left for playback), and calls
+    on_result(filename, bpm, onsets) from the main loop with each result.
+
+    The pool forks, so this has to be created before any other thread is
+    started.
+    """
+
+    def __init__(self, on_result, jobs=0):
+        self.on_result = on_result
+        self.jobs = jobs or max(1, multiprocessing.cpu_count() - 1)
+        self.pool = multiprocessing.Pool(self.jobs)
+        self._cond = threading.Condition()
+        self._pending = deque()
+        self._queued = set()
+        thread = threading.Thread(target=self._run, name="tempo")
+        thread.daemon = True
+        thread.start()
+
+    def request(self, filenames, urgent=False):
+        """Queue filenames, ahead of the others if urgent."""
+        with self._cond:
+            for filename in filenames:
+                if urgent:
+                    self._queued.discard(filename)
+                if filename not in self._queued:
+                    self._queued.add(filename)
+                    if urgent:
+                        self._pending.appendleft(filename)
+                    else:
+                        self._pending.append(filename)
+            self._cond.notify()
+
+    def clear(self):
+        """Forget the files not handed to the pool yet."""
+        with self._cond:
+            self._pending.clear()
+            self._queued.clear()
+
+    def close(self):
+        self.pool.terminate()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                # small batches, so that clear() and urgent requests are soon taken into account
+                batch = [self._pending.popleft() for n in range(min(len(self._pending), 4 * self.jobs))]
+                self._queued.difference_update(batch)
+            try:
+                for result in self.pool.imap_unordered(tempo_of, batch):
+                    gobject.idle_add(self._deliver, *result)
+            except Exception as e:
+                print "Tempo analysis failed:", e
+
+    def _deliver(self, filename, bpm, onsets):
+        self.on_result(filename, bpm, onsets)
+        return False
+
+
+def format_tags(tags, element=None):
+    """Format a tag dict as "name : value" lines, or just the value of tag `element`."""
+    tag_string = ""
+    if element:
+        if element in tags:
+            tag_string += " " + str(tags[element]) + '\r\n'
+    else:
+        for tag_name in list(tags.keys()):
+            if tag_name != "image":
+                tag_string += tag_name + " : " + str(tags[tag_name]) + '\r\n'
+    return tag_string
+
+
+def _pbutils():
+    """gst.pbutils, imported on first use."""
+    import gst.pbutils
+    return gst.pbutils
+
+
+def discoverer_info(info):
+    """Turn a gst.pbutils.DiscovererInfo into a dict of tags, duration, rate and channels."""
+    tags = info.get_tags()
+    result = {
+        "tags": dict((k, tags[k]) for k in tags.keys() if k != "image") if tags else {},
+        "duration": float(info.get_duration()) / gst.SECOND,
+        "rate": 0,
+        "channels": 0,
+    }
+    streams = info.get_audio_streams()
+    if streams:
+        result["rate"] = streams[0].get_sample_rate()
+        result["channels"] = streams[0].get_channels()
+    return result
+
+
+class MetadataService(object):
+    """
+    Asynchronous, cached front-end to gst.pbutils.Discoverer.
+
+    A single discoverer runs in asynchronous mode for the whole session and
+    reports back through the main loop. Results are dicts with the "tags",
+    "duration" (seconds), "rate" and "channels" of a file, kept in an LRU
+    of `size` entries keyed by path and mtime, so a file is only probed
+    again once it changes.
+    """
+
+    def __init__(self, timeout=10, size=1024):
+        self.timeout = timeout * gst.SECOND
+        self.size = size
+        self.cache = OrderedDict()
+        self._pending = {}
+        self._discoverer = None
+
+    def _key(self, filename):
+        filename = os.path.abspath(filename)
+        return filename, os.stat(filename).st_mtime
+
+    def _uri(self, filename):
+        return "file://" + urllib.pathname2url(os.path.abspath(filename))
+
+    def lookup(self, filename):
+        """Return the cached info of filename, or None."""
+        try:
+            key = self._key(filename)
+        except OSError:
+            return None
+        info = self.cache.pop(key, None)
+        if info is not None:
+            self.cache[key] = info
+        return info
+
+    def request(self, filename, callback):
+        """Call callback(filename, info) once the info of filename is known (None on failure)."""
+        info = self.lookup(filename)
+        if info is not None:
+            callback(filename, info)
+            return
+        uri = self._uri(filename)
+        if uri in self._pending:
+            self._pending[uri][1].append(callback)
+            return
+        self._pending[uri] = (filename, [callback])
+        if self._discoverer is None:
+            self._discoverer = _pbutils().Discoverer(self.timeout)
+            self._discoverer.connect("discovered", self._on_discovered)
+            self._discoverer.start()
+        self._discoverer.discover_uri_async(uri)
+
+    def discover(self, filename):
+        """Synchronous variant of request(), for callers that have to wait anyway."""
+        info = self.lookup(filename)
+        if info is None:
+            discoverer = _pbutils().Discoverer(self.timeout)
+            info = self._store(filename, discoverer.discover_uri(self._uri(filename)))
+        return info
+
+    def _on_discovered(self, discoverer, info, error):
+        filename, callbacks = self._pending.pop(info.get_uri(), (None, []))
+        result = None
+        if filename and not error:
+            result = self._store(filename, info)
+        for callback in callbacks:
+            callback(filename, result)
+
+    def _store(self, filename, info):
+        result = discoverer_info(info)
+        try:
+            key = self._key(filename)
+        except OSError:
+            return result
+        self.cache[key] = result
+        while len(self.cache) > self.size:
+            self.cache.popitem(last=False)
+        return result
+
+
+class LibraryIndex(object):
+    """
+    SQLite index of the audio files below a set of library roots.
+
+    Each file is stored with its size, mtime, mode, duration, rate,
+    channels and Discoverer tags, and its name, folders and tags go into
+    an FTS4 table for prefix search (SQLite builds without FTS4 fall back
+    to LIKE). Connections are per thread, so the crawler and the GUI can
+    each open their own.
+    """
+
+    def __init__(self, filename=None):
+        self.filename = filename or os.path.join(cache_dir, "library.db")
+        directory = os.path.dirname(self.filename)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.db = sqlite3.connect(self.filename, timeout=30)
+        # paths are byte strings, as os.walk returns them
+        self.db.text_factory = str
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS files (
+            id INTEGER PRIMARY KEY, path TEXT UNIQUE, size INTEGER, mtime REAL, mode INTEGER,
+            duration REAL, rate INTEGER, channels INTEGER, tags TEXT)""")
+        try:
+            self.db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS files_fts USING fts4(words, tags)")
+            self.fts = True
+        except sqlite3.OperationalError:
+            self.fts = False
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def known(self, root):
+        """Return {path: (size, mtime)} for the indexed files below root."""
+        prefix = root.rstrip(os.sep)
+        cursor = self.db.execute("SELECT path, size, mtime FROM files WHERE path >= ? AND path < ?",
+                                 (prefix + os.sep, prefix + chr(ord(os.sep) + 1)))
+        return dict((path, (size, mtime)) for path, size, mtime in cursor)
+
+    def store(self, path, filestat, info):
+        tags = dict((k, str(v)) for k, v in info.get("tags", {}).items())
+        self.remove([path])
+        cursor = self.db.execute(
+            "INSERT INTO files (path, size, mtime, mode, duration, rate, channels, tags) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (path, filestat.st_size, filestat.st_mtime, filestat.st_mode,
+             info.get("duration", 0.0), info.get("rate", 0), info.get("channels", 0), json.dumps(tags)))
+        if self.fts:
+            self.db.execute("INSERT INTO files_fts (docid, words, tags) VALUES (?, ?, ?)",
+                            (cursor.lastrowid, search_words(path), " ".join(tags.values())))
+
+    def remove(self, paths):
+        for path in paths:
+            if self.fts:
+                self.db.execute("DELETE FROM files_fts WHERE docid IN (SELECT id FROM files WHERE path = ?)", (path,))
+            self.db.execute("DELETE FROM files WHERE path = ?", (path,))
+
+    def commit(self):
+        self.db.commit()
+
+    def search(self, text, limit=500):
+        """Return (path, size, mode, mtime, duration) rows matching every word of text."""
+        words = re.findall(r"\w+", text.lower(), re.UNICODE)
+        if not words:
+            return []
+        if self.fts:
+            query = " ".join(w + "*" for w in words)
+            cursor = self.db.execute(
+                "SELECT f.path, f.size, f.mode, f.mtime, f.duration FROM files_fts JOIN files f ON f.id = files_fts.docid"
+                " WHERE files_fts MATCH ? ORDER BY f.path LIMIT ?", (query, limit))
+        else:
+            where = " AND ".join(["lower(path || ' ' || tags) LIKE ?"] * len(words))
+            cursor = self.db.execute("SELECT path, size, mode, mtime, duration FROM files WHERE %s ORDER BY path LIMIT ?" % where,
+                                     ["%" + w + "%" for w in words] + [limit])
+        return cursor.fetchall()
+
+
+def search_words(path):
+    """Split the file name and folders of path into lowercase words, camelCase and digits apart."""
+    text = re.sub(r"(?<=[a-z])(?=[A-Z])|(?<=[A-Za-z])(?=[0-9])|(?<=[0-9])(?=[A-Za-z])", " ", os.path.splitext(path)[0])
+    return " ".join(re.findall(r"[^\W_]+", text.lower(), re.UNICODE))
+
+
+class LibraryCrawler(threading.Thread):
+    """
+    Keeps a LibraryIndex up to date with the audio files below `roots`.
+
+    Only files whose size or mtime differ from the index are probed again
+    (WavReader for WAVs, a Discoverer for tags and everything else), and
+    files that disappeared are dropped.
+    """
+
+    def __init__(self, roots, on_done=None):
+        threading.Thread.__init__(self, name="library-crawler")
+        self.daemon = True
+        self.roots = roots
+        self.on_done = on_done
+
+    def run(self):
+        index = LibraryIndex()
+        discoverer = _pbutils().Discoverer(10 * gst.SECOND)
+        changed = 0
+        for root in self.roots:
+            known = index.known(root)
+            for dirpath, dirnames, filenames in os.walk(root):
+                dirnames[:] = [d for d in dirnames if d[0] != '.']
+                for name in filenames:
+                    if name[0] == '.' or not name.endswith(tuple(audio_formats)):
+                        continue
+                    path = os.path.join(dirpath, name)
+                    filestat = _stat(path)
+                    if filestat is None:
+                        continue
+                    if known.pop(path, None) == (filestat.st_size, filestat.st_mtime):
+                        continue
+                    index.store(path, filestat, probe_file(path, discoverer))
+                    changed += 1
+                    if changed % 200 == 0:
+                        index.commit()
+            index.remove(known)
+            index.commit()
+        index.close()
+        if self.on_done:
+            gobject.idle_add(self.on_done, changed)
+
+
+def probe_file(path, discoverer):
+    """Return the metadata dict of path (see MetadataService), {} if it can not be read."""
+    info = {}
+    try:
+        info = discoverer_info(discoverer.discover_uri("file://" + urllib.pathname2url(path)))
+    except Exception as e:
+        print "Could not discover", path, ":", e
+    if not info.get("rate"):
+        try:
+            with WavReader(path) as wav:
+                info.update(duration=wav.duration, rate=wav.rate, channels=wav.nchannels)
+        except (IOError, ValueError):
+            pass
+    return info
+
+
+def _afmhot(image):
+    """Map a uint8 image to cairo RGB24 pixels along a black-red-yellow-white ramp."""
+    x = image.astype(np.float32) / 255
+    r = (np.clip(2 * x, 0, 1) * 255).astype(np.uint32)
+    g = (np.clip(2 * x - 0.5, 0, 1) * 255).astype(np.uint32)
+    b = (np.clip(2 * x - 1, 0, 1) * 255).astype(np.uint32)
+    return (r << 16) | (g << 8) | b
+
+
+class LatencyStats(object):
+    """
+    Durations of the hot paths of auditioning a file, by span name.
+
+    span(name) (or the timed() decorator) times a block of code. arm()
+    starts the clock that first_buffer(), a buffer probe on the audio
+    sinks, stops: that is the "first-audio" span, from the click to the
+    first buffer reaching the sound card. Only the last `size` durations
+    of each span are kept.
+    """
+
+    def __init__(self, size=1000):
+        self.size = size
+        self.spans = {}
+        self.lock = threading.Lock()
+        self._armed = None
+
+    def record(self, name, seconds):
+        with self.lock:
+            if name not in self.spans:
+                self.spans[name] = deque(maxlen=self.size)
+            self.spans[name].append(seconds)
+
+    @contextlib.contextmanager
+    def span(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(name, time.time() - start)
+
+    def arm(self):
+        self._armed = time.time()
+
+    def disarm(self):
+        self._armed = None
+
+    def first_buffer(self, pad, buffer):
+        armed, self._armed = self._armed, None
+        if armed is not None:
+            self.record("first-audio", time.time() - armed)
+        return True
+
+    def summary(self):
+        """Count and 50th, 90th, 99th percentile and max duration (ms) of each span."""
+        with self.lock:
+            spans = [(name, np.array(durations) * 1000) for name, durations in sorted(self.spans.items())]
+        return OrderedDict((name, OrderedDict([
+            ("count", len(durations)),
+            ("p50", float(np.percentile(durations, 50))),
+            ("p90", float(np.percentile(durations, 90))),
+            ("p99", float(np.percentile(durations, 99))),
+            ("max", float(durations.max()))])) for name, durations in spans)
+
+    def dump(self, filename):
+        with open(filename, "w") as f:
+            json.dump({"time": time.time(), "spans": self.summary()}, f, indent=2)
+
+
+def timed(name):
+    """Record the duration of a GUI method as span `name` of its self.latency."""
+    def decorate(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.latency.span(name):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorate
+
+
+class Playlist(object):
+    """
+    The audio rows of a list model, in display order.
+
+    It is built in one pass over the model (no file system access) the
+    first time it is needed after rows were added, removed or sorted, and
+    then steps from any row to the next or previous audio one, in order or
+    shuffled, in constant time.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self._rows = None
+        for signal in ("row-inserted", "row-deleted", "rows-reordered"):
+            model.connect(signal, self.invalidate)
+
+    def invalidate(self, *args):
+        self._rows = None
+
+    def _build(self):
+        audio = np.array([row[COL_AUDIO] for row in self.model], dtype=bool)
+        self._audio = audio
+        self._rows = np.flatnonzero(audio)
+        # number of audio rows before each row
+        self._rank = np.cumsum(audio) - audio
+        self._order = np.random.permutation(len(self._rows))
+        self._place = np.argsort(self._order)
+
+    def __len__(self):
+        if self._rows is None:
+            self._build()
+        return len(self._rows)
+
+    def step(self, row, offset, shuffle=False, loop=False):
+        """
+        Return the index of the audio row `offset` (1 or -1) audio rows away
+        from row index `row` (None to start from either end), or None past
+        the end of the list, unless loop is set.
+        """
+        count = len(self)
+        if not count:
+            return None
+        start = -1 if offset > 0 else count
+        if row is None or row >= len(self._audio):
+            rank = place = start
+        elif self._audio[row]:
+            rank = self._rank[row]
+            place = self._place[rank]
+        else:
+            # between two audio rows, and not in the shuffled order
+            rank = self._rank[row] - (offset > 0)
+            place = start
+        target = (place if shuffle else rank) + offset
+        if loop:
+            target %= count
+        elif not 0 <= target < count:
+            return None
+        if shuffle:
+            target = self._order[target]
+        return int(self._rows[target])
+
+
+class WaveformView(gtk.DrawingArea):
+    """
+    Persistent cairo view of a file's peaks or spectrogram image.
+
+    One instance is reused for every file: set_peaks(), set_spectrogram()
+    and set_message() only swap what is drawn and queue a redraw.
+
+    The drawing is rendered once into an offscreen surface (again only when
+    the data, the size or the view change), and the playhead set by
+    set_position() is drawn over it, so moving it only repaints the few
+    pixels around its old and new positions.
+
+    Waveforms can be zoomed with the scroll wheel (around the pointer) and
+    panned with shift+scroll or by dragging; a double click shows the
+    whole file again. Each redraw only reads the pyramid level matching
+    the zoom, and past its finest level the samples of a WAV file are
+    read straight from its memory map.
+    """
+
+    waveform_color = (1.0, 0.27, 0.0)     # OrangeRed
+    rms_color = (0.55, 0.0, 0.0)          # DarkRed
+    axis_color = (0.41, 0.41, 0.41)       # DimGray
+    playhead_color = (0.0, 0.0, 0.0)
+    onset_color = (0.12, 0.56, 1.0)       # DodgerBlue
+
+    zoom_step = 1.5
+    min_frames = 64
+
+    def __init__(self):
+        gtk.DrawingArea.__init__(self)
+        self.peaks = None
+        self.image = None
+        self.message = None
+        self._surface = None
+        self._pixels = None
+        self._background = None
+        self._reader = None
+        self.filename = None
+        self._drag = None
+        self.start = self.stop = 0
+        self.onsets = None
+        self.position = None
+        self.add_events(gtk.gdk.SCROLL_MASK | gtk.gdk.BUTTON_PRESS_MASK |
+                        gtk.gdk.BUTTON_RELEASE_MASK | gtk.gdk.POINTER_MOTION_MASK)
+        self.connect("expose-event", self.on_expose)
+        self.connect("size-allocate", lambda widget, allocation: self.invalidate())
+        self.connect("scroll-event", self.on_scroll)
+        self.connect("button-press-event", self.on_button_press)
+        self.connect("button-release-event", self.on_button_release)
+        self.connect("motion-notify-event", self.on_motion)
+
+    def invalidate(self):
+        self._background = None
+        self.queue_draw()
+
+    def set_peaks(self, peaks, filename=None):
+        """Show a PeakPyramid; the samples of filename, if a WAV file, back the deepest zoom."""
+        if filename is None or filename != self.filename or self.peaks is None or peaks.nframes != self.peaks.nframes:
+            self._close_reader()
+            self.filename = filename
+            self.start, self.stop = 0, peaks.nframes
+            if filename is not None:
+                try:
+                    self._reader = WavReader(filename)
+                except (IOError, ValueError):
+                    pass
+        self.peaks, self.image, self.message = peaks, None, None
+        self.invalidate()
+
+    def _close_reader(self):
+        if self._reader is not None:
+            self._reader.close()
+        self._reader = None
+        self.filename = None
+
+    def set_spectrogram(self, image):
+        self._close_reader()
+        self.peaks, self.image, self.message = None, image, None
+        if image.size:
+            # cairo reads the pixels in place, so keep them alongside the surface
+            self._pixels = np.ascontiguousarray(_afmhot(image[::-1]))
+            height, width = self._pixels.shape
+            self._surface = cairo.ImageSurface.create_for_data(self._pixels, cairo.FORMAT_RGB24, width, height, width * 4)
+        self.invalidate()
+
+    def set_onsets(self, onsets):
+        """Mark these times (s) on the waveform, or nothing if None."""
+        self.onsets = onsets
+        self.invalidate()
+
+    def set_message(self, message):
+        self._close_reader()
+        self.peaks, self.image, self.message = None, None, message
+        self.position = None
+        self.invalidate()
+
+    def set_position(self, position):
+        """Move the playhead to position (0 to 1 of the file), None to hide it."""
+        old = self._playhead_x()
+        self.position = position
+        new = self._playhead_x()
+        if old != new:
+            for x in (old, new):
+                if x is not None:
+                    self.queue_draw_area(x - 1, 0, 3, self.allocation.height)
+
+    def _playhead_x(self):
+        if self.position is None:
+            return None
+        if self.peaks is None or not self.peaks.nframes:
+            return int(min(max(self.position, 0.0), 1.0) * (self.allocation.width - 1))
+        frame = self.position * self.peaks.nframes
+        if not self.start <= frame <= self.stop:
+            return None
+        return int((frame - self.start) / float(self.stop - self.start) * (self.allocation.width - 1))
+
+    def set_view(self, start, stop):
+        """Show frames start to stop of the waveform, clamped to the file."""
+        if self.peaks is None:
+            return
+        nframes = self.peaks.nframes
+        length = min(max(int(stop - start), self.min_frames), nframes)
+        start = min(max(int(start), 0), nframes - length)
+        if (start, start + length) != (self.start, self.stop):
+            self.start, self.stop = start, start + length
+            self.invalidate()
+
+    def _frame_at(self, x):
+        return self.start + (self.stop - self.start) * float(x) / max(1, self.allocation.width)
+
+    def on_scroll(self, widget, event):
+        if self.peaks is None:
+            return False
+        length = self.stop - self.start
+        if event.direction in (gtk.gdk.SCROLL_UP, gtk.gdk.SCROLL_DOWN) and not event.state & gtk.gdk.SHIFT_MASK:
+            factor = 1 / self.zoom_step if event.direction == gtk.gdk.SCROLL_UP else self.zoom_step
+            anchor = self._frame_at(event.x)
+            self.set_view(anchor - (anchor - self.start) * factor, anchor + (self.stop - anchor) * factor)
+        else:
+            shift = length / 8
+            if event.direction in (gtk.gdk.SCROLL_UP, gtk.gdk.SCROLL_LEFT):
+                shift = -shift
+            self.set_view(self.start + shift, self.stop + shift)
+        return True
+
+    def on_button_press(self, widget, event):
+        if self.peaks is None or event.button != 1:
+            return False
+        if event.type == gtk.gdk._2BUTTON_PRESS:
+            self.set_view(0, self.peaks.nframes)
+        else:
+            self._drag = (event.x, self.start, self.stop)
+        return True
+
+    def on_button_release(self, widget, event):
+        self._drag = None
+        return False
+
+    def on_motion(self, widget, event):
+        if self._drag is None:
+            return False
+        x, start, stop = self._drag
+        shift = (x - event.x) * (stop - start) / max(1, self.allocation.width)
+        self.set_view(start + shift, stop + shift)
+        return True
+
+    def on_expose(self, widget, event):
+        width, height = self.allocation.width, self.allocation.height
+        if self._background is None or (self._background.get_width(), self._background.get_height()) != (width, height):
+            self._background = cairo.ImageSurface(cairo.FORMAT_RGB24, max(1, width), max(1, height))
+            self.render(cairo.Context(self._background), width, height)
+        cr = self.window.cairo_create()
+        cr.rectangle(event.area.x, event.area.y, event.area.width, event.area.height)
+        cr.clip()
+        cr.set_source_surface(self._background, 0, 0)
+        cr.paint()
+        x = self._playhead_x()
+        if x is not None:
+            cr.set_source_rgb(*self.playhead_color)
+            cr.set_line_width(1)
+            cr.move_to(x + 0.5, 0)
+            cr.line_to(x + 0.5, height)
+            cr.stroke()
+        return False
+
+    def render(self, cr, width, height):
+        cr.set_source_rgb(1, 1, 1)
+        cr.paint()
+        if self.peaks is not None:
+            self.draw_peaks(cr, width, height)
+        elif self.image is not None and self.image.size:
+            self.draw_spectrogram(cr, width, height)
+        elif self.message:
+            cr.set_source_rgb(0, 0, 0)
+            extents = cr.text_extents(self.message)
+            cr.move_to((width - extents[2]) / 2, (height + extents[3]) / 2)
+            cr.show_text(self.message)
+
+    def visible_peaks(self, width):
+        """The (mins, maxs, rms) columns of the current view, at most `width` of them."""
+        peaks = self.peaks.view(self.start, self.stop, width)
+        if peaks is not None:
+            return peaks
+        if self._reader is None:
+            return self.peaks.view(self.start, self.stop, width, level=0)
+        acc = PeakAccumulator(max(1, -(-(self.stop - self.start) // width)))
+        for block in self._reader.normalised_chunks(start=self.start, stop=self.stop):
+            acc.feed(block)
+        return acc.peaks()
+
+    def draw_peaks(self, cr, width, height):
+        if not self.peaks.nframes or self.stop <= self.start:
+            return
+        mins, maxs, rms = self.visible_peaks(max(1, width))
+        if not len(mins):
+            return
+        # fill the height like an autoscaled plot would
+        scale = (height / 2.0) / max(float(max(maxs.max(), -mins.min())), 1e-6)
+        mid = height / 2.0
+        x = np.arange(len(mins)) * (float(width) / len(mins))
+        for top, bottom, color in ((maxs, mins, self.waveform_color), (rms, -rms, self.rms_color)):
+            cr.move_to(x[0], mid - top[0] * scale)
+            for px, py in zip(x[1:], mid - top[1:] * scale):
+                cr.line_to(px, py)
+            for px, py in zip(x[::-1], mid - bottom[::-1] * scale):
+                cr.line_to(px, py)
+            cr.close_path()
+            cr.set_source_rgb(*color)
+            cr.fill()
+        cr.set_source_rgb(*self.axis_color)
+        cr.set_line_width(1)
+        cr.move_to(0, int(mid) + 0.5)
+        cr.line_to(width, int(mid) + 0.5)
+        cr.stroke()
+        if self.onsets is not None and self.peaks.rate:
+            frames = self.onsets * self.peaks.rate
+            xs = (frames[(frames >= self.start) & (frames < self.stop)] - self.start) * width / (self.stop - self.start)
+            for x in xs.astype(int):
+                cr.move_to(x + 0.5, 0)
+                cr.line_to(x + 0.5, height)
+            cr.set_source_rgb(*self.onset_color)
+            cr.stroke()
+
+    def draw_spectrogram(self, cr, width, height):
+        bands, columns = self.image.shape
+        cr.scale(float(width) / columns, float(height) / bands)
+        cr.set_source_surface(self._surface, 0, 0)
+        cr.paint()
+
 
 class GUI(object):
 
-    column_names = ["Name", "Size", "Mode", "Last Changed"]
-    audioFormats = [ ".wav", ".mp3", ".ogg", ".flac", ".MP3", ".FLAC", ".OGG", ".WAV", "wma" ]
+    column_names = ["Name", "Size", "Mode", "Last Changed", "BPM"]
+    sort_columns = [COL_NAME, COL_SIZE, COL_MODE, COL_MTIME, COL_BPM]
+    audioFormats = audio_formats
 
     def __init__(self, dname = None):
 
@@ -113,6 +2159,21 @@ class GUI(object):
         else:
             dname = None
 
+        self.list_loader = None
+        # name -> whether to select it, of the files that showed up while loading
+        self.deferred_rows = OrderedDict()
+        self.monitor = None
+        # model column the list is sorted on (None: as listed) and order
+        self.sort_column = None
+        self.sort_order = gtk.SORT_ASCENDING
+        self.sort_source = None
+        self.row_iters = {}
+        self.playlist = None
+        self.latency = LatencyStats()
+        # forks its worker processes, so before any other thread
+        self.tempo = TempoService(self.on_tempo)
+        self.onsets = OrderedDict()
+
         self.window = gtk.Window()
         self.window.set_size_request(550, 600)
         self.window.connect("delete_event", self.on_destroy)
@@ -121,7 +2182,7 @@ class GUI(object):
     # lister
 
         cell_data_funcs = (None, self.file_size, self.file_mode,
-                           self.file_last_changed)
+                           self.file_last_changed, self.file_bpm)
 
         self.list_store = self.make_list(dname)
         self.treeview = gtk.TreeView()
@@ -144,18 +2205,23 @@ class GUI(object):
             cell = gtk.CellRendererText()
             self.tvcolumn[n] = gtk.TreeViewColumn(self.column_names[n], cell)
 
-
-            # make it searchable (does NOT work, please help)
-            # self.treeview.set_search_column(True)
-
-            # Allow sorting on the column (does NOT work, please help)
-            self.tvcolumn[n].set_sort_column_id(n)
-
-            if n == 1:
+            if n in (1, 4):
                 cell.set_property('xalign', 1.0)
 
             self.tvcolumn[n].set_cell_data_func(cell, cell_data_funcs[n])
             self.treeview.append_column(self.tvcolumn[n])
+
+        # sorted here rather than by the model: see sort_rows()
+        for n, tvcolumn in enumerate(self.tvcolumn):
+            tvcolumn.set_clickable(True)
+            tvcolumn.connect("clicked", self.on_sort_clicked, self.sort_columns[n])
+
+        cell = gtk.CellRendererPixbuf()
+        self.thumbnail_column = gtk.TreeViewColumn("", cell)
+        self.thumbnail_column.set_cell_data_func(cell, self.file_thumbnail)
+        self.thumbnail_column.set_sizing(gtk.TREE_VIEW_COLUMN_FIXED)
+        self.thumbnail_column.set_fixed_width(ThumbnailService.width + 8)
+        self.treeview.insert_column(self.thumbnail_column, 1)
         self.treeview.set_model(self.list_store)
 
         self.tree_selection = self.treeview.get_selection()
@@ -171,9 +2237,12 @@ class GUI(object):
         self.slider = gtk.HScale()
         self.toggle_button = gtk.ToggleButton(None)
 
+        self.prev_button = gtk.Button(None)
         self.next_button = gtk.Button(None)
+        self.shuffle_button = gtk.ToggleButton(None)
 
         self.toggle_button.set_property("image", gtk.image_new_from_stock(gtk.STOCK_MEDIA_PLAY, gtk.ICON_SIZE_BUTTON))
+        self.prev_button.set_property("image", gtk.image_new_from_stock(gtk.STOCK_MEDIA_PREVIOUS, gtk.ICON_SIZE_BUTTON))
         self.next_button.set_property("image", gtk.image_new_from_stock(gtk.STOCK_MEDIA_NEXT, gtk.ICON_SIZE_BUTTON))
 
         self.buttons_hbox = gtk.HBox(False, 5)
@@ -181,17 +2250,56 @@ class GUI(object):
         self.slider.set_range(0, 100)
         self.slider.set_increments(1, 10)
 
+        self.buttons_hbox.pack_start(self.prev_button, False)
         self.buttons_hbox.pack_start(self.toggle_button, False)
         self.buttons_hbox.pack_start(self.next_button, False)
+        self.buttons_hbox.pack_start(self.shuffle_button, False)
         self.buttons_hbox.pack_start(self.label, False)
+
+        self.library = None
+        self.search_timeout = None
+        if library_roots and sqlite3 is not None:
+            self.library = LibraryIndex()
+            self.search_entry = gtk.Entry()
+            self.search_entry.set_tooltip_text("Search the sample library")
+            self.search_entry.connect("changed", self.on_search_changed)
+            self.buttons_hbox.pack_end(self.search_entry, False)
+            # not before the window is up
+            gobject.idle_add(lambda: LibraryCrawler(library_roots, self.on_library_crawled).start())
         self.slider_hbox.pack_start(self.slider, True, True)
 
-        self.playbin = gst.element_factory_make('playbin2')
-        self.bus = self.playbin.get_bus()
-        self.bus.add_signal_watch()
-        self.bus.connect("message::eos", self.on_finish)
+        self.file_playbin = self.make_playbin()
+        # prerolled on the next audio row, swapped in on "next"
+        self.next_playbin = self.make_playbin()
+        self.prerolled = None
+        self.sample_cache = SampleCache()
+        self.memory_player = MemoryPlayer()
+        self.watch_pipeline(self.memory_player.pipeline)
+        self.probe_audio(self.memory_player.pipeline.get_by_name("sink"), self.memory_player.pipeline)
+        # whichever of the above is playing
+        self.playbin = self.file_playbin
 
         self.is_playing = False
+        self.current_filename = None
+        # the one timeout polling the position, while a pipeline is PLAYING
+        self.position_source = None
+        self.plot_type = "waveform"
+
+        self.metadata = MetadataService()
+        self.peak_cache = PeakCache()
+        # one np.load per entry: far too slow for the main loop on a big cache
+        purger = threading.Thread(target=self.peak_cache.purge_stale, name="peak-cache-purge")
+        purger.daemon = True
+        purger.start()
+        self.waveform_worker = WaveformWorker(self.peak_cache, self.sample_cache, self.latency)
+        self.waveform_worker.start()
+        self.properties_worker = None
+
+        theme = gtk.icon_theme_get_default()
+        self.icons = dict((name, theme.load_icon(name, 24, 0)) for name in ("folder", "audio-volume-medium", "edit-copy"))
+        self.thumbnails = ThumbnailService(self.peak_cache, self.treeview.queue_draw)
+        self.thumbnail_source = None
+        self.treeview.connect_after("expose-event", self.on_treeview_expose)
 
     # end player
 
@@ -208,14 +2316,28 @@ class GUI(object):
 
         self.actiongroup.add_actions([
             ("Properties", gtk.STOCK_PROPERTIES, "_Properties", None, "File info", self.file_properties_dialog),
-            ("Quit", gtk.STOCK_QUIT, "_Quit", None, "Quit the Application", lambda w: gtk.main_quit()),
+            ("Quit", gtk.STOCK_QUIT, "_Quit", None, "Quit the Application", self.on_destroy),
             ("File", None, "_File"),
             ("Preferences", gtk.STOCK_PREFERENCES, "_Preferences", None, "Edit the Preferences"),
             ("Edit", None, "_Edit"),
+            ("CacheStats", None, "_Cache statistics", None, "Sample cache hits and misses", self.cache_stats_box),
+            ("Latency", None, "_Latency", None, "Time spent between a click and hearing the file", self.latency_window),
             ("About", gtk.STOCK_ABOUT, "_About", None, "yow", self.about_box),
             ("Help", None, "_Help")
         ])
 
+        self.actiongroup.add_toggle_actions([
+            ("PlayThrough", None, "Play _through folder", None, "Go on with the next file at the end of each one", None, False),
+            ("Shuffle", None, "_Shuffle", None, "Play the files of the folder in random order", None, False),
+            ("Loop", None, "_Loop", None, "Start over after the last file of the folder", None, False)
+        ])
+        self.actiongroup.get_action("Shuffle").connect_proxy(self.shuffle_button)
+
+        self.actiongroup.add_radio_actions([
+            ("Waveform", None, "_Waveform", None, "Show the waveform of the file", 0),
+            ("Spectrogram", None, "_Spectrogram", None, "Show the spectrogram of the file", 1),
+        ], 0, self.on_plot_type)
+
         uimanager.insert_action_group(self.actiongroup, 0)
         uimanager.add_ui_from_string(menu)
 
@@ -223,6 +2345,7 @@ class GUI(object):
 
         # Connects
         self.toggle_button.connect("toggled", self.toggle_play, None, "current", self.treeview, self.tree_selection)
+        self.prev_button.connect("clicked", self.toggle_play, None, "previous", self.treeview, self.tree_selection)
         self.next_button.connect("clicked", self.toggle_play, None, "next", self.treeview, self.tree_selection)
         self.slider.connect('value-changed', self.on_slider_change)
         self.treeview.connect('row-activated', self.open_file)
@@ -230,9 +2353,9 @@ class GUI(object):
 
         # Packs
         self.mainbox = gtk.VBox()
-        self.plot_inbox = gtk.HBox(True, 0)
+        self.waveform = WaveformView()
         self.plot_outbox = gtk.VBox(True, 0)
-        self.plot_outbox.pack_start(self.plot_inbox, True, True, 0)
+        self.plot_outbox.pack_start(self.waveform, True, True, 0)
         self.plot_outbox.set_size_request(200, 60)
 
         self.mainbox.pack_start(menubar, False)
@@ -247,43 +2370,20 @@ class GUI(object):
         return
 
 
-    def _wav2array(nchannels, sampwidth, data):
-        """data must be the string containing the bytes from the wav file."""
-        num_samples, remainder = divmod(len(data), sampwidth * nchannels)
-        if remainder > 0:
-            raise ValueError('The length of data is not a multiple of '
-                             'sampwidth * num_channels.')
-        if sampwidth > 4:
-            raise ValueError("sampwidth must not be greater than 4.")
+    @timed("get_info")
+    def get_info(self, filename, element=None):
+        info = self.metadata.discover(filename)
+        return format_tags(info["tags"], element)
 
-        if sampwidth == 3:
-            a = np.empty((num_samples, nchannels, 4), dtype=np.uint8)
-            raw_bytes = np.fromstring(data, dtype=np.uint8)
-            a[:, :, :sampwidth] = raw_bytes.reshape(-1, nchannels, sampwidth)
-            a[:, :, sampwidth:] = (a[:, :, sampwidth - 1:sampwidth] >> 7) * 255
-            result = a.view('<i4').reshape(a.shape[:-1])
-        else:
-            # 8 bit samples are stored as unsigned ints; others as signed ints.
-            dt_char = 'u' if sampwidth == 1 else 'i'
-            a = np.fromstring(data, dtype='<%s%d' % (dt_char, sampwidth))
-            result = a.reshape(-1, nchannels)
-            return result
+    def show_label(self, filename):
+        self.current_filename = filename
+        self.label.set_markup("<b> " + os.path.basename(filename) + "</b>\n")
+        self.metadata.request(filename, self.on_info)
 
-    def get_info(self, filename, element=None):
-        newitem = gst.pbutils.Discoverer(50000000000)
-        info = newitem.discover_uri("file://" + filename)
-        tags = info.get_tags()
-        tag_string = ""
-        if element:
-            for tag_name in list(tags.keys()):
-                if tag_name == element:
-                    tag_string += " " + str(tags[tag_name]) + '\r\n'
-                return tag_string
-        else:
-            for tag_name in list(tags.keys()):
-                if tag_name != "image":
-                    tag_string += tag_name + " : " + str(tags[tag_name]) + '\r\n'
-            return tag_string
+    def on_info(self, filename, info):
+        if info and filename == self.current_filename:
+            audio_codec_tag = format_tags(info["tags"], "audio-codec")
+            self.label.set_markup("<b> " + os.path.basename(filename) + "</b>\n" + audio_codec_tag)
 
     def file_properties_dialog(self, widget):
         filename = self.get_selected_tree_row(self)
@@ -311,15 +2411,61 @@ class GUI(object):
         dialog.add_button(gtk.STOCK_CLOSE, gtk.RESPONSE_CLOSE)
         dialog.connect('destroy', lambda w: dialog.destroy())
 
-        if filename.endswith(".wav") or filename.endswith(".WAV"):
-            pa = self.plotter(filename, "waveform", "full")
-            pa.set_size_request(350, 200)
-            dialog.vbox.pack_start(pa)
+        if filename.endswith(tuple(self.audioFormats)):
+            view = WaveformView()
+            view.set_size_request(350, 200)
+            view.set_message("...")
+            dialog.vbox.pack_start(view)
+
+            def show(filename, peaks):
+                if peaks is None:
+                    view.set_message("No Viz")
+                else:
+                    view.set_peaks(peaks, filename)
+
+            # its own worker, not to cancel the player's waveform
+            if self.properties_worker is None:
+                self.properties_worker = WaveformWorker(self.peak_cache)
+                self.properties_worker.start()
+            self.properties_worker.submit(filename, show)
 
         dialog.show_all()
         dialog.run()
+        if self.properties_worker is not None:
+            self.properties_worker.cancel()
         dialog.destroy()
 
+    def cache_stats_box(self, widget):
+        stats = self.sample_cache.stats()
+        md = gtk.MessageDialog(None, gtk.DIALOG_DESTROY_WITH_PARENT, gtk.MESSAGE_INFO,
+                               gtk.BUTTONS_CLOSE, "Sample cache")
+        md.format_secondary_text("Hits : %(hits)d\r\nMisses : %(misses)d\r\nHit rate : %(hit_rate).0f%%\r\n"
+                                 % dict(stats, hit_rate=stats["hit_rate"] * 100)
+                                 + "Entries : %d\r\nSize : %s" % (stats["entries"], k_to_m(stats["bytes"])))
+        md.run()
+        md.destroy()
+
+    def latency_window(self, widget):
+        window = gtk.Window()
+        window.set_title("Latency - BNP")
+        window.set_default_size(450, 250)
+        store = gtk.ListStore(str, int, str, str, str, str)
+        view = gtk.TreeView(store)
+        for n, title in enumerate(["Span", "Count", "p50 (ms)", "p90 (ms)", "p99 (ms)", "Max (ms)"]):
+            view.append_column(gtk.TreeViewColumn(title, gtk.CellRendererText(), text=n))
+        window.add(view)
+
+        def refresh():
+            store.clear()
+            for name, stats in self.latency.summary().items():
+                store.append([name, stats["count"]] + ["%.1f" % stats[key] for key in ("p50", "p90", "p99", "max")])
+            return True
+
+        refresh()
+        source = gobject.timeout_add(1000, refresh)
+        window.connect("destroy", lambda w: gobject.source_remove(source))
+        window.show_all()
+
     def about_box(self, widget):
         about = gtk.AboutDialog()
         about.set_program_name("BeatNitPicker")
@@ -333,16 +2479,17 @@ class GUI(object):
         about.run()
         about.destroy()
 
+    @timed("open_file")
     def open_file(self, treeview, path, button, *args):
         model = treeview.get_model()
         iter = model.get_iter(path)
-        filename = os.path.join(self.dirname, model.get_value(iter, 0))
-        filestat = os.stat(filename)
+        filename = model.get_value(iter, COL_PATH)
 
-        if stat.S_ISDIR(filestat.st_mode):
-            new_model = self.make_list(filename)
-            treeview.set_model(new_model)
-        elif filename.endswith(tuple(self.audioFormats)):
+        if model.get_value(iter, COL_ISDIR):
+            self.list_store = self.make_list(filename)
+            treeview.set_model(self.list_store)
+        elif model.get_value(iter, COL_AUDIO):
+            self.latency.arm()
             self.toggle_play(self, filename, "current", None, None)
         else:
             print("##", filename, "is not an audio file")
@@ -354,44 +2501,38 @@ class GUI(object):
         slider_position =  self.slider.get_value()
         for path in pathlist :
             iter = model.get_iter(path)
-            filename = os.path.join(self.dirname, model.get_value(iter, 0))
-            filestat = os.stat(filename)
-            if stat.S_ISDIR(filestat.st_mode):
+            filename = model.get_value(iter, COL_PATH)
+            if model.get_value(iter, COL_ISDIR):
                 print(filename, "is a directory")
-            elif filename.endswith(tuple(self.audioFormats)):
+            elif model.get_value(iter, COL_AUDIO):
                 return filename
             else:
                 print("##", filename, "is not an audio file")
 
     def get_next_tree_row(self, *args):
-        treeview = self.treeview
-        selection = treeview.get_selection()
-        (model, pathlist) = selection.get_selected_rows()
-        # print "Model: ", model, "Pathlist: ", pathlist, "Longueur: ", pathlist.count()
-
-        slider_position =  self.slider.get_value()
-        for path in pathlist :
-            iter = model.get_iter(path)
-            next_iter = model.iter_next(iter)
-            filename = os.path.join(self.dirname, model.get_value(iter, 0))
-            next_filename = os.path.join(self.dirname, model.get_value(next_iter, 0))
-            filestat = os.stat(next_filename)
-            current = filename
-            if stat.S_ISDIR(filestat.st_mode):
-                # print next_filename, "is a ddirectory"
-                # next_filename = self.get_next_tree_row(self)
-                # print "current", current
-                # print "next", next_filename
-                selection.select_iter(next_iter)
-                # pass
-                # if next_filename != current:
-            elif next_filename.endswith(tuple(self.audioFormats)):
-                return next_filename
-                selection.select_iter(next_iter)
-            else:
-                print("##", next_filename, "is not an audio file")
-
+        row = self.step_row(1)
+        if row is not None:
+            return self.treeview.get_model()[row][COL_PATH]
+
+    def get_playlist(self):
+        model = self.treeview.get_model()
+        if self.playlist is None or self.playlist.model is not model:
+            self.playlist = Playlist(model)
+        return self.playlist
+
+    def step_row(self, offset):
+        """Index of the audio row offset (1 or -1) rows away from the selected one, or None."""
+        (model, iter) = self.tree_selection.get_selected()
+        row = model.get_path(iter)[0] if iter is not None else None
+        return self.get_playlist().step(row, offset,
+                                        self.actiongroup.get_action("Shuffle").get_active(),
+                                        self.actiongroup.get_action("Loop").get_active())
+
+    @timed("toggle_play")
     def toggle_play(self, button, filename, position, tv, selection):
+        if button is not self:
+            # open_file() armed it already
+            self.latency.arm()
 
         if position == "current":
             # print "current", self.get_next_tree_row(self)
@@ -406,6 +2547,7 @@ class GUI(object):
                 slider_position =  self.slider.get_value()
 
                 if self.is_playing:
+                    self.latency.disarm()
                     self.toggle_button.set_property("image", gtk.image_new_from_stock(gtk.STOCK_MEDIA_PLAY,  gtk.ICON_SIZE_BUTTON))
                     self.is_playing = False
                     self.playbin.set_state(gst.STATE_PAUSED)
@@ -413,186 +2555,434 @@ class GUI(object):
                     if slider_position > 0.0:
                         self.toggle_button.set_property("image", gtk.image_new_from_stock(gtk.STOCK_MEDIA_PAUSE,  gtk.ICON_SIZE_BUTTON))
                         self.playbin.set_state(gst.STATE_PLAYING)
-                        gobject.timeout_add(100, self.update_slider)
                         self.is_playing = True
-                    else:
+                    elif filename:
                         self.toggle_button.set_property("image", gtk.image_new_from_stock(gtk.STOCK_MEDIA_PAUSE,  gtk.ICON_SIZE_BUTTON))
                         self.player(self, filename)
                         self.is_playing = True
+                    else:
+                        # nothing to play
+                        self.latency.disarm()
 
             re.search('(?<=abc)def', 'abcdef')
-            audio_codec_tag = self.get_info(filename, "audio-codec")
-            self.label.set_markup("<b> " + os.path.basename(filename) + "</b>\n" + audio_codec_tag)
+            if filename:
+                self.show_label(filename)
         else:
 
-            (model, pathlist) = selection.get_selected_rows()
-
-            for path in pathlist :
-                iter = model.get_iter(path)
-                next_iter = model.iter_next
-            filename = self.get_next_tree_row(self)
+            row = self.step_row(-1 if position == "previous" else 1)
+            filename = row is not None and tv.get_model()[row][COL_PATH]
             if filename:
-                myint = reduce(lambda rst, d: rst * 10 + d, path)
-                selection.unselect_path(myint)
-                selection.select_path(myint + 1)
-                print "Filename: ", filename
+                selection.select_path((row,))
+                tv.scroll_to_cell((row,))
                 self.toggle_button.set_property("image", gtk.image_new_from_stock(gtk.STOCK_MEDIA_PAUSE,  gtk.ICON_SIZE_BUTTON))
                 self.player(self, filename)
                 self.is_playing = True
+                self.show_label(filename)
             else:
                 print "NO Filename"
-                pass
+                self.latency.disarm()
 
+    @timed("player")
     def player(self, button, filename):
-        self.plot_outbox.remove(self.plot_inbox)
-
         self.playbin.set_state(gst.STATE_READY)
-        self.playbin.set_property('uri', 'file:///' + filename)
+        cached = self.sample_cache.get(filename)
+        if cached is not None:
+            self.memory_player.load(cached)
+            self.playbin = self.memory_player.pipeline
+        elif filename == self.prerolled:
+            self.file_playbin, self.next_playbin = self.next_playbin, self.file_playbin
+            self.playbin = self.file_playbin
+            self.prerolled = None
+        else:
+            self.playbin = self.file_playbin
+            self.playbin.set_property('uri', 'file:///' + filename)
         self.is_playing = True
         self.playbin.set_state(gst.STATE_PLAYING)
-        gobject.timeout_add(100, self.update_slider)
-
-        self.vp = gtk.Viewport()
-        self.plot_inbox = gtk.HBox()
-
-        self.mylabel = gtk.Label("No Viz")
-
-        readable = False
-
-        try:
-            f = open(filename, 'r')
-            w = wavfile.read(open(filename, 'r'))
-            readable = True
-        except IOError as e:
-            print "I/O error({0}): {1}".format(e.errno, e.strerror)
-            readable = False
-        except ValueError:
-            print "Error opening file for plotting: Will not draw waveform."
-            readable = False
-        except:
-            print "Unexpected error:", sys.exc_info()[0]
-            readable = False
-            raise
-
-        if readable:
-            self.pa = self.plotter(filename, "waveform", "neat")
-            self.plot_inbox.pack_start(self.pa)
+        gobject.idle_add(self.preroll_next)
+
+        self.waveform.set_message("...")
+        self.waveform_worker.submit(filename, self.show_waveform, self.plot_type)
+        if filename not in self.onsets:
+            self.tempo.request([filename], urgent=True)
+
+    def show_waveform(self, filename, data):
+        if data is None:
+            self.waveform.set_message("No Viz")
+        elif self.plot_type == "spectrogram":
+            self.waveform.set_spectrogram(data)
         else:
-            self.plot_inbox.pack_start(self.mylabel)
-
-        self.plot_outbox.pack_start(self.plot_inbox, True, True, 0)
-        self.window.show_all()
-
-    def plotter(self, filename, plot_type, plot_style):
-        rate, data = wavfile.read(open(filename, 'r'), True)
-        # rate, data, array = readwav(filename)
-        # print("Rate: ", rate)
-
-        f = Figure(facecolor = 'w')
-        f.patch.set_alpha(1)
-        a = f.add_subplot(111, axisbg='w')
-
-        if plot_type == "waveform":
-            a.plot(list(range(len(data))),data, color="OrangeRed",  linewidth=0.5, linestyle="-")
-            a.axhline(0, color='DimGray', lw=1)
-            a.set_xticklabels(["", ""])
-            a.set_yticklabels(["", ""])
-        if plot_style == "neat":
-            f.subplots_adjust(0, 0, 1, 1)
-            a.axis('off')
-        canvas = FigureCanvas(f)  # a gtk.DrawingArea
-        return canvas
+            self.waveform.set_peaks(data, filename)
+            self.waveform.set_onsets(self.onsets.get(filename))
 
     # Lister funcs
 
-    def lister_compare(self, model, row1, row2, user_data):
-        sort_column, _ = model.get_sort_column_id()
-        value1 = model.get_value(row1, sort_column)
-        value2 = model.get_value(row2, sort_column)
-        if value1 < value2:
-            return -1
-        elif value1 == value2:
-            return 0
+    def on_sort_clicked(self, tvcolumn, column):
+        if column == self.sort_column and self.sort_order == gtk.SORT_ASCENDING:
+            self.sort_order = gtk.SORT_DESCENDING
         else:
-            return 1
-
+            self.sort_order = gtk.SORT_ASCENDING
+        self.sort_column = column
+        for other in self.tvcolumn:
+            other.set_sort_indicator(other is tvcolumn)
+        tvcolumn.set_sort_order(self.sort_order)
+        self.sort_rows(self.treeview.get_model())
+
+    def sort_rows(self, model):
+        """
+        Reorder model on the sort column, once: each value is read a single
+        time, instead of in every comparison of a model sort func.
+        """
+        if self.sort_column is None:
+            return
+        groups = []
+        values = []
+        for row in model:
+            # ".." stays on top and directories before files, whatever the order
+            groups.append((row[COL_NAME] != '..', not row[COL_ISDIR]))
+            values.append(row[self.sort_column])
+        order = sorted(range(len(values)), key=values.__getitem__,
+                       reverse=self.sort_order == gtk.SORT_DESCENDING)
+        order.sort(key=groups.__getitem__)
+        if order != range(len(order)):
+            model.reorder(order)
+
+    def schedule_sort(self):
+        # values of the sort column changed: sort again, at most once a second
+        if self.sort_column is not None and self.sort_source is None:
+            self.sort_source = gobject.timeout_add(1000, self.on_sort_timeout)
+
+    def on_sort_timeout(self):
+        self.sort_source = None
+        self.sort_rows(self.list_store)
+        return False
+
+    def sorts_before(self, row1, row2):
+        """Whether row1 goes before row2 in the list, as sorted (or listed) now."""
+        if self.sort_column is None:
+            # as listed by iter_directory()
+            return (row1[COL_NAME] != '..', row1[COL_NAME]) < (row2[COL_NAME] != '..', row2[COL_NAME])
+        group1 = (row1[COL_NAME] != '..', not row1[COL_ISDIR])
+        group2 = (row2[COL_NAME] != '..', not row2[COL_ISDIR])
+        if group1 != group2:
+            return group1 < group2
+        if self.sort_order == gtk.SORT_DESCENDING:
+            return row1[self.sort_column] > row2[self.sort_column]
+        return row1[self.sort_column] < row2[self.sort_column]
+
+    @timed("make_list")
     def make_list(self, dname=None):
         if not dname:
             self.dirname = os.path.expanduser('~')
         else:
             self.dirname = os.path.abspath(dname)
         self.window.set_title(self.dirname + " - BNP")
-        files = [f for f in os.listdir(self.dirname) if f[0] != '.']
-        files.sort()
-        files = ['..'] + files
-        list_store = gtk.ListStore(object)
-        for f in files:
-            list_store.append([f])
+        list_store = gtk.ListStore(*list_columns)
+
+        # fill the first screen now and stream the rest in from idle time
+        if self.list_loader:
+            gobject.source_remove(self.list_loader)
+            self.list_loader = None
+        self.row_iters = {}
+        self.deferred_rows.clear()
+        self.list_store = list_store
+        self.tempo.clear()
+        self.watch_directory()
+        batches = iter_directory(self.dirname, 256, 64)
+        if self.append_rows(list_store, batches):
+            self.window.set_title(self.dirname + " (loading) - BNP")
+            self.list_loader = gobject.idle_add(self.append_rows, list_store, batches)
         return list_store
 
+    def append_rows(self, list_store, batches):
+        try:
+            rows = next(batches)
+        except StopIteration:
+            self.list_loader = None
+            self.window.set_title(self.dirname + " - BNP")
+            # appended as listed meanwhile
+            self.sort_rows(list_store)
+            for name, selected in self.deferred_rows.items():
+                self.update_row(name)
+                iter = self.row_iters.get(name)
+                if selected and iter is not None:
+                    self.tree_selection.select_iter(iter)
+            self.deferred_rows.clear()
+            return False
+        first = not len(list_store)
+        for row in rows:
+            if row[COL_NAME] not in self.row_iters:
+                self.row_iters[row[COL_NAME]] = list_store.append(row)
+        if first:
+            self.sort_rows(list_store)
+        self.tempo.request([row[COL_PATH] for row in rows if row[COL_AUDIO]])
+        return True
+
+    def watch_directory(self):
+        if self.monitor:
+            self.monitor.cancel()
+        self.monitor = gio.File(self.dirname).monitor_directory(gio.FILE_MONITOR_SEND_MOVED)
+        self.monitor.connect("changed", self.on_directory_changed)
+
+    def on_directory_changed(self, monitor, gfile, other_file, event):
+        if monitor is not self.monitor:
+            return
+        name = gfile.get_basename()
+        if event == gio.FILE_MONITOR_EVENT_DELETED:
+            self.remove_row(name)
+        elif event in (gio.FILE_MONITOR_EVENT_CREATED,
+                       gio.FILE_MONITOR_EVENT_CHANGES_DONE_HINT,
+                       gio.FILE_MONITOR_EVENT_ATTRIBUTE_CHANGED):
+            self.update_row(name)
+        elif event == gio.FILE_MONITOR_EVENT_MOVED:
+            iter = self.row_iters.get(name)
+            selected = iter is not None and self.tree_selection.iter_is_selected(iter)
+            self.remove_row(name)
+            if other_file and other_file.get_parent().get_path() == self.dirname:
+                new_name = other_file.get_basename()
+                self.update_row(new_name)
+                iter = self.row_iters.get(new_name)
+                if selected and iter is not None:
+                    self.tree_selection.select_iter(iter)
+                elif selected and new_name in self.deferred_rows:
+                    self.deferred_rows[new_name] = True
+
+    def update_row(self, name):
+        if name[0] == '.':
+            return
+        path = os.path.join(self.dirname, name)
+        filestat = _stat(path)
+        if filestat is None:
+            self.remove_row(name)
+            return
+        iter = self.row_iters.get(name)
+        if iter is None and self.list_loader is not None:
+            # the binary search would only see the rows loaded so far
+            self.deferred_rows.setdefault(name, False)
+            return
+        row = file_row(name, path, filestat)
+        if iter is None:
+            self.row_iters[name] = self.list_store.insert(self.listing_position(row), row)
+        else:
+            for column, value in enumerate(row):
+                self.list_store.set_value(iter, column, value)
+            self.schedule_sort()
+        if row[COL_AUDIO]:
+            self.tempo.request([path])
+
+    def listing_position(self, row):
+        low, high = 0, len(self.list_store)
+        while low < high:
+            middle = (low + high) // 2
+            if self.sorts_before(self.list_store[middle], row):
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def remove_row(self, name):
+        self.deferred_rows.pop(name, None)
+        iter = self.row_iters.pop(name, None)
+        if iter is not None:
+            self.list_store.remove(iter)
+
     def file_pixbuf(self, column, cell, model, iter):
-        filename = os.path.join(self.dirname, model.get_value(iter, 0))
-        filestat = os.stat(filename)
-        if stat.S_ISDIR(filestat.st_mode):
-            pb = gtk.icon_theme_get_default().load_icon("folder", 24, 0)
-        elif filename.endswith(tuple(self.audioFormats)):
-            pb = gtk.icon_theme_get_default().load_icon("audio-volume-medium", 24, 0)
+        if model.get_value(iter, COL_ISDIR):
+            pb = self.icons["folder"]
+        elif model.get_value(iter, COL_AUDIO):
+            pb = self.icons["audio-volume-medium"]
         else:
-            pb = gtk.icon_theme_get_default().load_icon("edit-copy", 24, 0)
+            pb = self.icons["edit-copy"]
+        cell.set_property('pixbuf', pb)
+        return
+
+    def file_thumbnail(self, column, cell, model, iter):
+        pb = None
+        if model.get_value(iter, COL_AUDIO):
+            pb = self.thumbnails.get(model.get_value(iter, COL_PATH), model.get_value(iter, COL_MTIME))
         cell.set_property('pixbuf', pb)
         return
 
+    def file_bpm(self, column, cell, model, iter):
+        bpm = model.get_value(iter, COL_BPM)
+        cell.set_property('text', "%.1f" % bpm if bpm else "")
+        return
+
+    def on_tempo(self, filename, bpm, onsets):
+        self.onsets[filename] = onsets
+        while len(self.onsets) > 256:
+            self.onsets.popitem(last=False)
+        iter = self.row_iters.get(os.path.basename(filename))
+        if bpm and iter is not None and os.path.dirname(filename) == self.dirname:
+            self.list_store.set_value(iter, COL_BPM, bpm)
+            if self.sort_column == COL_BPM:
+                self.schedule_sort()
+        if filename == self.current_filename and self.waveform.peaks is not None:
+            self.waveform.set_onsets(onsets)
+
+    def on_treeview_expose(self, treeview, event):
+        # whatever got the list redrawn (scrolling, sorting, new rows) may have shown new rows
+        if self.thumbnail_source is None:
+            self.thumbnail_source = gobject.idle_add(self.request_thumbnails)
+        return False
+
+    def request_thumbnails(self, prefetch=32):
+        """Have the thumbnails of the visible rows rendered, then those of `prefetch` rows around them."""
+        self.thumbnail_source = None
+        visible = self.treeview.get_visible_range()
+        if not visible:
+            return False
+        model = self.treeview.get_model()
+        first, last = visible[0][0], visible[1][0]
+        rows = range(first, last + 1)
+        for n in range(1, prefetch + 1):
+            rows += [last + n, first - n]
+        files = []
+        for row in rows:
+            if 0 <= row < len(model) and model[row][COL_AUDIO]:
+                files.append((model[row][COL_PATH], model[row][COL_MTIME]))
+        self.thumbnails.request(files)
+        return False
+
     def file_name(self, column, cell, model, iter):
-        cell.set_property('text', model.get_value(iter, 0))
+        cell.set_property('text', model.get_value(iter, COL_NAME))
         return
 
     def file_size(self, column, cell, model, iter):
-        filename = os.path.join(self.dirname, model.get_value(iter, 0))
-        filestat = os.stat(filename)
-        # print("Size: ", bytestomegabytes(filestat.st_size), "Mb")
-
-        size = str(k_to_m(filestat.st_size))
+        size = str(k_to_m(model.get_value(iter, COL_SIZE)))
         cell.set_property('text', size)
         return
 
     def file_mode(self, column, cell, model, iter):
-        filename = os.path.join(self.dirname, model.get_value(iter, 0))
-        filestat = os.stat(filename)
-        cell.set_property('text', oct(stat.S_IMODE(filestat.st_mode)))
+        cell.set_property('text', oct(stat.S_IMODE(model.get_value(iter, COL_MODE))))
         return
 
     def file_last_changed(self, column, cell, model, iter):
-        filename = os.path.join(self.dirname, model.get_value(iter, 0))
-        filestat = os.stat(filename)
-        cell.set_property('text', time.ctime(filestat.st_mtime))
+        cell.set_property('text', time.ctime(model.get_value(iter, COL_MTIME)))
         return
 
 
+    def on_plot_type(self, action, current):
+        self.plot_type = ("waveform", "spectrogram")[current.get_current_value()]
+        if self.current_filename:
+            self.waveform_worker.submit(self.current_filename, self.show_waveform, self.plot_type)
+
+    # Library funcs
+
+    def on_search_changed(self, entry):
+        if self.search_timeout:
+            gobject.source_remove(self.search_timeout)
+        self.search_timeout = gobject.timeout_add(150, self.search_library)
+
+    def search_library(self):
+        self.search_timeout = None
+        text = self.search_entry.get_text().strip()
+        if not text:
+            # the sort may have changed meanwhile
+            self.sort_rows(self.list_store)
+            self.treeview.set_model(self.list_store)
+            self.window.set_title(self.dirname + " - BNP")
+            return False
+        results = gtk.ListStore(*list_columns)
+        home = os.path.expanduser('~')
+        for path, size, mode, mtime, duration in self.library.search(text):
+            name = path.replace(home, '~', 1) if path.startswith(home) else path
+            results.append([name, path, False, size, mode, mtime, True, 0.0])
+        self.sort_rows(results)
+        self.treeview.set_model(results)
+        self.window.set_title("Search: " + text + " - BNP")
+        return False
+
+    def on_library_crawled(self, changed):
+        if changed and self.search_entry.get_text().strip():
+            self.search_library()
+        return False
+
     # player funcs
 
+    def make_playbin(self):
+        playbin = gst.element_factory_make('playbin2')
+        sink = gst.element_factory_make('autoaudiosink')
+        playbin.set_property('audio-sink', sink)
+        self.probe_audio(sink, playbin)
+        self.watch_pipeline(playbin)
+        return playbin
+
+    def probe_audio(self, sink, pipeline):
+        sink.get_static_pad("sink").add_buffer_probe(self.on_audio_buffer, pipeline)
+
+    def on_audio_buffer(self, pad, buffer, pipeline):
+        # not the preroll of the next row, which may well come first
+        if pipeline is self.playbin:
+            self.latency.first_buffer(pad, buffer)
+        return True
+
+    def watch_pipeline(self, pipeline):
+        bus = pipeline.get_bus()
+        bus.add_signal_watch()
+        bus.connect("message::eos", self.on_finish)
+        bus.connect("message::state-changed", self.on_state_changed)
+
+    def preroll_next(self):
+        filename = self.get_next_tree_row()
+        if filename and filename != self.prerolled and self.sample_cache.get(filename, False) is None:
+            self.next_playbin.set_state(gst.STATE_READY)
+            self.next_playbin.set_property('uri', 'file:///' + filename)
+            self.next_playbin.set_state(gst.STATE_PAUSED)
+            self.prerolled = filename
+        return False
+
+    def on_state_changed(self, bus, message):
+        if message.src is not self.playbin:
+            return
+        old, new, pending = message.parse_state_changed()
+        if new == gst.STATE_PLAYING:
+            if self.position_source is None:
+                self.position_source = gobject.timeout_add(50, self.update_slider)
+        elif self.position_source is not None:
+            gobject.source_remove(self.position_source)
+            self.position_source = None
+            self.update_slider()
+
     def on_finish(self, bus, message):
+        if message.src is not self.playbin:
+            return
+        if self.actiongroup.get_action("PlayThrough").get_active() and self.get_next_tree_row():
+            self.toggle_play(None, None, "next", self.treeview, self.tree_selection)
+            return
         self.playbin.set_state(gst.STATE_PAUSED)
         self.is_playing = False
         self.playbin.seek_simple(gst.FORMAT_TIME, gst.SEEK_FLAG_FLUSH, 0)
         self.slider.set_value(0)
+        self.waveform.set_position(0)
         self.toggle_button.set_property("image", gtk.image_new_from_stock(gtk.STOCK_MEDIA_PLAY,  gtk.ICON_SIZE_BUTTON))
 
     def on_destroy(self, *args):
         self.playbin.set_state(gst.STATE_NULL)
+        self.next_playbin.set_state(gst.STATE_NULL)
+        self.file_playbin.set_state(gst.STATE_NULL)
+        self.memory_player.pipeline.set_state(gst.STATE_NULL)
+        self.tempo.close()
         self.is_playing = False
+        if latency_log:
+            self.latency.dump(latency_log)
         gtk.main_quit()
 
     def on_slider_change(self, slider):
         seek_time_secs = self.slider.get_value()
         self.playbin.seek_simple(gst.FORMAT_TIME, gst.SEEK_FLAG_FLUSH | gst.SEEK_FLAG_KEY_UNIT, seek_time_secs * gst.SECOND)
+        upper = self.slider.get_adjustment().get_upper()
+        if upper > 0:
+            self.waveform.set_position(seek_time_secs / upper)
 
     def update_slider(self):
-        if not self.is_playing:
-            return False # cancel timeout
-
         try:
             self.nanosecs, format = self.playbin.query_position(gst.FORMAT_TIME)
-            self.duration_nanosecs, format = self.playbin.query_duration(gst.FORMAT_TIME)
+            try:
+                self.duration_nanosecs, format = self.playbin.query_duration(gst.FORMAT_TIME)
+            except gst.QueryError:
+                if self.playbin is not self.memory_player.pipeline:
+                    raise
+                self.duration_nanosecs = self.memory_player.duration
 
             # block seek handler so we don't seek when we set_value()
             self.slider.handler_block_by_func(self.on_slider_change)
@@ -602,16 +2992,778 @@ class GUI(object):
 
             self.slider.handler_unblock_by_func(self.on_slider_change)
 
+            if self.duration_nanosecs > 0:
+                self.waveform.set_position(float(self.nanosecs) / self.duration_nanosecs)
+
         except gst.QueryError:
             # pipeline must not be ready and does not know position
             pass
 
-        return True # continue calling every 30 milliseconds
+        return True # continue calling every 50 milliseconds
+
+
+# Headless analysis
+
+class SignalStats(object):
+    """
+    Streaming level statistics over normalised (frames, channels) blocks:
+    peak, RMS, DC offset and the number of samples at or above
+    `clip_level`.
+    """
+
+    def __init__(self, clip_level=0.999):
+        self.clip_level = clip_level
+        self.frames = 0
+        self.samples = 0
+        self.peak = 0.0
+        self.total = 0.0
+        self.squares = 0.0
+        self.clipped = 0
+
+    def feed(self, block):
+        if not len(block):
+            return
+        magnitude = np.abs(block)
+        self.frames += len(block)
+        self.samples += block.size
+        self.peak = max(self.peak, float(magnitude.max()))
+        self.total += float(block.sum(dtype=np.float64))
+        self.squares += float(np.square(block, dtype=np.float64).sum())
+        self.clipped += int(np.count_nonzero(magnitude >= self.clip_level))
+
+    @property
+    def rms(self):
+        return (self.squares / self.samples) ** 0.5 if self.samples else 0.0
+
+    @property
+    def dc_offset(self):
+        return self.total / self.samples if self.samples else 0.0
+
+
+def _dbfs(value):
+    return round(20 * np.log10(value), 2) if value > 0 else None
+
+
+analysis_fields = ["path", "duration", "rate", "channels", "peak_dbfs", "rms_dbfs", "dc_offset", "clipped", "error"]
+
+
+def analyze_file(path):
+    """Return the analysis_fields of one audio file as a dict."""
+    result = dict.fromkeys(analysis_fields)
+    result["path"] = path
+    try:
+        try:
+            wav = WavReader(path)
+        except ValueError:
+            wav = None
+        if wav is not None:
+            with wav:
+                stats = SignalStats()
+                if wav.dtype is not None and wav.dtype.kind != 'f':
+                    # the largest positive integer sample is just below 1.0
+                    half = 2.0 ** (8 * wav.sampwidth - 1)
+                    stats.clip_level = min(stats.clip_level, (half - 1) / half)
+                elif wav.sampwidth == 3:
+                    stats.clip_level = min(stats.clip_level, (2.0 ** 23 - 1) / 2 ** 23)
+                for block in wav.normalised_chunks(1 << 18):
+                    stats.feed(block)
+                rate, channels = wav.rate, wav.nchannels
+        else:
+            info = {}
+            stats = SignalStats()
+            for block in decode_chunks(path, info):
+                stats.feed(block)
+            rate, channels = info.get("rate", 0), info.get("channels", 0)
+    except (IOError, OSError, ValueError) as e:
+        result["error"] = str(e)
+        return result
+    result.update(
+        duration=round(float(stats.frames) / rate, 6) if rate else 0.0,
+        rate=rate,
+        channels=channels,
+        peak_dbfs=_dbfs(stats.peak),
+        rms_dbfs=_dbfs(stats.rms),
+        dc_offset=round(stats.dc_offset, 8),
+        clipped=stats.clipped,
+    )
+    return result
+
+
+def find_audio_files(root):
+    """Yield the paths of the non-hidden audio files below root, in a stable order."""
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(d for d in dirnames if d[0] != '.')
+        for name in sorted(filenames):
+            if name[0] != '.' and name.endswith(tuple(audio_formats)):
+                yield os.path.join(dirpath, name)
+
+
+def analyze(root, output, format="csv", jobs=0):
+    """
+    Analyze every audio file below root with a pool of `jobs` processes
+    (one per core by default) and write one record per file to output.
+    Returns the number of files that could not be read.
+    """
+    pool = multiprocessing.Pool(jobs or multiprocessing.cpu_count())
+    failed = 0
+    try:
+        results = pool.imap(analyze_file, find_audio_files(root), 16)
+        if format == "json":
+            output.write("[")
+            for n, result in enumerate(results):
+                failed += result["error"] is not None
+                output.write((",\n " if n else "\n ") + json.dumps(result, sort_keys=True))
+            output.write("\n]\n")
+        else:
+            writer = csv.DictWriter(output, analysis_fields)
+            writer.writeheader()
+            for result in results:
+                failed += result["error"] is not None
+                writer.writerow(result)
+        pool.close()
+    except BaseException:
+        # a bare join() would hide the error behind an AssertionError
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return failed
+
+
+# Duplicates
+
+# Files are fingerprinted over their first seconds only
+fingerprint_seconds = 30
+# bits set in each 16 bit value
+_popcount = np.unpackbits(np.arange(1 << 16, dtype=">u2").view(np.uint8)).reshape(-1, 16).sum(axis=1, dtype=np.uint8)
+
+
+def fingerprint(samples, rate, segments=16, bands=24):
+    """
+    Return the fingerprint of float (frames, channels) samples, as 416
+    bytes: a 256 bit hash, then the levels it hashes.
+
+    From the first sound above -40 dB of the peak, the file is cut into
+    16 equal time segments, and the mean energy of each in 24 log spaced
+    bands from 30 Hz to 10 kHz is measured with batched FFTs. Those levels
+    are kept in dB below the loudest one (down to -40 dB, in quarter dB
+    steps), and hashed with 256 fixed random hyperplanes, so that the
+    number of differing bits of two hashes grows with the angle between
+    their levels. Gain changes, sample format conversions and added
+    silence leave both nearly untouched.
+
+    The FFT frames last 40 ms whatever the rate, so that their bins fall
+    on the same multiples of 25 Hz, and the bands stop below the Nyquist
+    frequency of 22.05 kHz: copies of a sound at any rate from there up
+    get close fingerprints too.
+    """
+    mono = np.ascontiguousarray(samples.mean(axis=1) if samples.ndim > 1 else samples, dtype=np.float32)
+    loud = np.flatnonzero(np.abs(mono) > np.abs(mono).max() * 0.01) if len(mono) else []
+    if len(loud):
+        mono = mono[loud[0]:]
+    nfft = int(round(rate / 25.0))
+    if len(mono) < nfft + segments:
+        mono = np.concatenate([mono, np.zeros(nfft + segments - len(mono), mono.dtype)])
+    # the same number of frames in each segment, at the same fractions of the sound whatever its rate
+    span = len(mono) - nfft
+    per_segment = max(1, span // (segments * (nfft // 2)))
+    count = segments * per_segment
+    starts = np.round(np.linspace(0, span, count)).astype(int)
+    offsets = np.arange(nfft)
+    freqs = np.logspace(np.log10(30), np.log10(10000), bands + 1)
+    edges = np.minimum(np.round(freqs * nfft / rate).astype(int), nfft // 2)
+    window = np.hanning(nfft).astype(np.float32)
+    energy = np.empty((count, bands))
+    for first in range(0, count, 256):
+        frames = mono[starts[first:first + 256, None] + offsets]
+        power = np.square(np.abs(np.fft.rfft(frames * window)))
+        total = np.concatenate([np.zeros((len(power), 1)), np.cumsum(power, axis=1)], axis=1)
+        energy[first:first + 256] = total[:, np.maximum(edges[1:], edges[:-1] + 1)] - total[:, edges[:-1]]
+    energy = energy.reshape(segments, per_segment, bands).mean(axis=1)
+    levels = 10 * np.log10(np.maximum(energy / (energy.max() + 1e-30), 1e-4)).ravel()
+    planes = np.random.RandomState(0).standard_normal((256, levels.size))
+    bits = np.packbits(planes.dot(levels - levels.mean()) > 0)
+    return np.concatenate([bits, np.round(-4 * levels).astype(np.uint8)])
+
+
+def fingerprint_file(path):
+    """Return (path, duration, fingerprint or None, error or None) for one audio file."""
+    try:
+        try:
+            wav = WavReader(path)
+        except ValueError:
+            wav = None
+        if wav is not None:
+            with wav:
+                rate, duration = wav.rate, wav.duration
+                stop = int(fingerprint_seconds * rate)
+                samples = np.concatenate(list(wav.normalised_chunks(stop=stop)) or [np.zeros((0, 1), np.float32)])
+        else:
+            info = {}
+            blocks = []
+            frames = 0
+            for block in decode_chunks(path, info):
+                blocks.append(block)
+                frames += len(block)
+                if frames >= fingerprint_seconds * info["rate"]:
+                    break
+            if not blocks:
+                raise ValueError("%s has no audio" % path)
+            rate = info["rate"]
+            duration = info.get("duration") or float(frames) / rate
+            samples = np.concatenate(blocks)
+        return path, duration, fingerprint(samples, rate), None
+    except (IOError, OSError, ValueError) as e:
+        return path, 0.0, None, str(e)
+
+
+class FingerprintIndex(object):
+    """
+    On-disk fingerprints of audio files, see fingerprint().
+
+    The index is a single .npz of parallel arrays, loaded whole: at 416
+    bytes a fingerprint, a library of 100k files takes about 40 MB.
+    update() only fingerprints the files whose size or mtime changed
+    since they were indexed.
+    """
+
+    version = 2
+
+    def __init__(self, filename=None):
+        self.filename = filename or os.path.join(cache_dir, "fingerprints.npz")
+        # path -> (size, mtime, duration, fingerprint)
+        self.entries = {}
+        try:
+            npz = np.load(self.filename)
+        except (IOError, OSError):
+            return
+        try:
+            if int(npz["version"]) == self.version:
+                for path, size, mtime, duration, fp in zip(npz["paths"], npz["sizes"], npz["mtimes"],
+                                                           npz["durations"], npz["fingerprints"]):
+                    self.entries[str(path)] = (int(size), float(mtime), float(duration), fp)
+        except (KeyError, ValueError):
+            self.entries = {}
+        finally:
+            npz.close()
+
+    def save(self):
+        paths = sorted(self.entries)
+        entries = [self.entries[path] for path in paths]
+        try:
+            directory = os.path.dirname(self.filename)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            tmp = self.filename[:-4] + ".%d.tmp.npz" % os.getpid()
+            np.savez(tmp, version=np.array(self.version),
+                     paths=np.array(paths, dtype=str),
+                     sizes=np.array([e[0] for e in entries], dtype=np.int64),
+                     mtimes=np.array([e[1] for e in entries], dtype=np.float64),
+                     durations=np.array([e[2] for e in entries], dtype=np.float64),
+                     fingerprints=np.array([e[3] for e in entries], dtype=np.uint8).reshape(len(entries), -1))
+            os.rename(tmp, self.filename)
+        except (IOError, OSError) as e:
+            print "Could not save the fingerprint index:", e
+
+    def update(self, root, jobs=0):
+        """
+        Bring the entries below root up to date with a pool of `jobs`
+        processes (one per core by default). Returns the paths of the
+        files below root that could not be fingerprinted.
+        """
+        found = set()
+        stale = []
+        for path in find_audio_files(root):
+            filestat = _stat(path)
+            if filestat is None:
+                continue
+            found.add(path)
+            entry = self.entries.get(path)
+            if entry is None or entry[:2] != (filestat.st_size, filestat.st_mtime):
+                stale.append((path, filestat))
+        prefix = os.path.join(root, "")
+        for path in [p for p in self.entries if p.startswith(prefix) and p not in found]:
+            del self.entries[path]
+        failed = []
+        if not stale:
+            return failed
+        stats = dict(stale)
+        pool = multiprocessing.Pool(jobs or multiprocessing.cpu_count())
+        try:
+            for path, duration, fp, error in pool.imap_unordered(fingerprint_file, [p for p, s in stale], 16):
+                if fp is None:
+                    self.entries.pop(path, None)
+                    failed.append(path)
+                else:
+                    self.entries[path] = (stats[path].st_size, stats[path].st_mtime, duration, fp)
+            pool.close()
+        except BaseException:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        return failed
+
+    def duplicates(self, root=None, max_distance=15, max_difference=0.5):
+        """
+        Return the groups (lists of sorted paths, largest groups first) of
+        indexed files below root whose hashes differ by at most
+        max_distance bits, and whose levels by at most max_difference dB
+        (RMS, once both are centered on the same mean).
+
+        Identical fingerprints are merged first. Then, instead of
+        comparing every pair, the 256 bits are cut into 8 bands of 32 bits
+        and only hashes with a band equal or one bit apart are compared:
+        two of them at most 15 bits apart always have one.
+        """
+        prefix = root and os.path.join(root, "")
+        paths = sorted(p for p in self.entries if not prefix or p.startswith(prefix))
+        if not paths:
+            return []
+        words = np.array([self.entries[p][3] for p in paths], dtype=np.uint8).view(np.uint64)
+        order = np.lexsort(words.T[::-1])
+        new = np.ones(len(order), dtype=bool)
+        new[1:] = (np.diff(words[order], axis=0) != 0).any(axis=1)
+        label = np.empty(len(paths), dtype=int)
+        label[order] = np.cumsum(new) - 1
+        fps = words[order[new]].view(np.uint8)
+        hashes = fps[:, :32]
+        halves = hashes.copy().view(np.uint16)
+        count = len(fps)
+        # every pair of hashes close enough, as first * count + second with first < second
+        close = np.zeros(0, dtype=np.int64)
+        for band in hashes.copy().view(np.uint32).T:
+            order = np.argsort(band, kind="mergesort")
+            keys = band[order]
+            starts = np.flatnonzero(np.append(True, keys[1:] != keys[:-1]))
+            lengths = np.diff(np.append(starts, len(keys)))
+            unique = keys[starts]
+            found = [close]
+            for bit in range(-1, 32):
+                if bit < 0:
+                    runs = np.flatnonzero(lengths > 1)
+                    pairs = _run_pairs(starts, lengths, runs, runs)
+                else:
+                    # each pair of runs one bit apart once
+                    other = unique ^ np.uint32(1 << bit)
+                    match = np.minimum(np.searchsorted(unique, other), len(unique) - 1)
+                    runs = np.flatnonzero((unique[match] == other) & (unique < other))
+                    pairs = _run_pairs(starts, lengths, runs, match[runs])
+                for first, second in pairs:
+                    first, second = order[first], order[second]
+                    near = _popcount[halves[first] ^ halves[second]].sum(axis=1, dtype=np.int32) <= max_distance
+                    first, second = first[near], second[near]
+                    found.append(np.minimum(first, second) * count + np.maximum(first, second))
+            # similar hashes share several bands: keep each pair once
+            close = np.unique(np.concatenate(found))
+        # then their levels, in quarter dB steps, each pair once
+        levels = fps[:, 32:].astype(np.int16)
+        # averaging can only bring levels closer: the mean level of each band
+        # rules out most pairs at a fraction of the cost
+        bands = levels.reshape(count, -1, 24).mean(axis=1, dtype=np.float32)
+        limit = (4 * max_difference) ** 2
+
+        def spread(values, pairs):
+            # mean square difference, once centered
+            first, second = np.divmod(pairs, count)
+            difference = values[first] - values[second]
+            return np.square(difference, dtype=np.float64).mean(axis=1) - np.square(difference.mean(axis=1))
+
+        similar = []
+        for start in range(0, len(close), 1 << 14):
+            pairs = close[start:start + (1 << 14)]
+            pairs = pairs[spread(bands, pairs) <= limit + 1e-3]
+            similar.append(pairs[spread(levels, pairs) <= limit])
+        first, second = np.divmod(np.concatenate(similar or [close]), count)
+        parent = _components(count, first, second)
+        groups = {}
+        for n in range(len(paths)):
+            groups.setdefault(parent[label[n]], []).append(paths[n])
+        return sorted((g for g in groups.values() if len(g) > 1), key=lambda g: (-len(g), g))
+
+
+def _components(count, first, second):
+    """
+    Return, for each of `count` nodes, the smallest node of the connected
+    component it belongs to in the graph of edges (first[n], second[n]).
+    """
+    label = np.arange(count)
+    while len(first):
+        # hook the larger label of each edge on the smaller one, then flatten
+        low = np.minimum(label[first], label[second])
+        np.minimum.at(label, label[first], low)
+        np.minimum.at(label, label[second], low)
+        while True:
+            up = label[label]
+            if (up == label).all():
+                break
+            label = up
+        apart = label[first] != label[second]
+        first, second = first[apart], second[apart]
+    return label
+
+
+def _run_pairs(starts, lengths, first, second, size=1 << 16):
+    """
+    Yield (i, j) index arrays of about `size` pairs at a time, covering
+    every i of run first[n] with every j of run second[n] of a sorted
+    array whose runs of equal values begin at starts. Where a run is
+    paired with itself, only the pairs with i < j are given.
+    """
+    counts = lengths[first]
+    if not counts.sum():
+        return
+    # one row per i: it goes with the `width` indices from `begin`
+    rows = np.repeat(starts[first] - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+    same = np.repeat(first == second, counts)
+    begin = np.where(same, rows + 1, np.repeat(starts[second], counts))
+    width = np.where(same, np.repeat(starts[first] + counts, counts) - rows - 1, np.repeat(lengths[second], counts))
+    ends = np.cumsum(width)
+    cuts = np.searchsorted(ends, np.arange(size, ends[-1], size))
+    for low, high in zip(np.append(0, cuts), np.append(cuts, len(rows))):
+        chunk = width[low:high]
+        if not chunk.sum():
+            continue
+        offsets = np.repeat(np.cumsum(chunk) - chunk, chunk)
+        index = np.repeat(np.arange(low, high), chunk)
+        yield rows[index], begin[index] + np.arange(len(index)) - offsets
+
+
+duplicate_fields = ["group", "path", "duration"]
+
+
+def find_duplicates(root, output, format="csv", jobs=0, index=None):
+    """
+    Update the fingerprint index below root, then write every group of
+    duplicate or near-duplicate files to output. Returns the number of
+    groups.
+    """
+    index = index or FingerprintIndex()
+    for path in index.update(root, jobs):
+        print >> sys.stderr, "Could not fingerprint", path
+    index.save()
+    groups = index.duplicates(root)
+    if format == "json":
+        json.dump([[dict(path=p, duration=round(index.entries[p][2], 6)) for p in group] for group in groups],
+                  output, indent=1, sort_keys=True)
+        output.write("\n")
+    else:
+        writer = csv.DictWriter(output, duplicate_fields)
+        writer.writeheader()
+        for n, group in enumerate(groups):
+            for path in group:
+                writer.writerow(dict(group=n + 1, path=path, duration=round(index.entries[path][2], 6)))
+    return len(groups)
+
+
+# Benchmarks
+
+# (folder, files, seconds, rate, channels, sample width in bytes, float)
+benchmark_library = [
+    ("oneshots", 1000, 0.25, 44100, 1, 2, False),
+    ("lofi", 200, 0.5, 22050, 1, 1, False),
+    ("loops", 100, 2.0, 48000, 2, 3, False),
+    ("float", 20, 4.0, 96000, 2, 4, True),
+    ("stems", 10, 30.0, 44100, 2, 2, False),
+]
+
+
+def write_wav(filename, samples, rate, sampwidth=2, is_float=False):
+    """Write float (frames, channels) samples in [-1, 1] as 8 to 32 bit PCM or 32 bit float WAV."""
+    frames, nchannels = samples.shape
+    if is_float:
+        data = samples.astype('<f4')
+    elif sampwidth == 1:
+        data = (samples * 127 + 128).astype(np.uint8)
+    elif sampwidth == 3:
+        data = (samples * (2 ** 23 - 1)).astype('<i4').view(np.uint8).reshape(-1, 4)[:, :3]
+    else:
+        data = (samples * (2 ** (8 * sampwidth - 1) - 1)).astype('<i%d' % sampwidth)
+    data = np.ascontiguousarray(data).tostring()
+    with open(filename, "wb") as f:
+        f.write(struct.pack("<4sI4s4sIHHIIHH4sI", "RIFF", 36 + len(data), "WAVE", "fmt ", 16,
+                            WAVE_FORMAT_IEEE_FLOAT if is_float else WAVE_FORMAT_PCM, nchannels, rate,
+                            rate * nchannels * sampwidth, nchannels * sampwidth, 8 * sampwidth,
+                            "data", len(data)))
+        f.write(data)
+
+
+def make_sample_library(root, scale=1.0, seed=0):
+    """Fill root with the folders of benchmark_library (`scale` times as many files), the same for a given seed."""
+    rng = np.random.RandomState(seed)
+    for folder, files, seconds, rate, nchannels, sampwidth, is_float in benchmark_library:
+        directory = os.path.join(root, folder)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        for n in range(max(1, int(files * scale))):
+            frames = int(seconds * rate * rng.uniform(0.5, 1.5))
+            samples = rng.uniform(-0.5, 0.5, (frames, nchannels)).astype(np.float32)
+            write_wav(os.path.join(directory, "%s-%04d.wav" % (folder, n)), samples, rate, sampwidth, is_float)
+
+
+def _directories(root):
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(d for d in dirnames if d[0] != '.')
+        yield dirpath
+
+
+def _wav_files(root):
+    for path in find_audio_files(root):
+        try:
+            yield WavReader(path)
+        except (IOError, ValueError):
+            pass
+
+
+def bench_listing(root):
+    rows = 0
+    for directory in _directories(root):
+        rows += len(list_directory(directory))
+    return rows, 0
+
+
+def bench_cells(root):
+    rows = [row for directory in _directories(root) for row in list_directory(directory)]
+    start = time.time()
+    for row in rows:
+        k_to_m(row[COL_SIZE])
+        oct(stat.S_IMODE(row[COL_MODE]))
+        time.ctime(row[COL_MTIME])
+    return len(rows), 0, time.time() - start
+
+
+def bench_next_track(root):
+    steps = 0
+    seconds = 0.0
+    for directory in _directories(root):
+        model = gtk.ListStore(*list_columns)
+        for row in list_directory(directory):
+            model.append(row)
+        start = time.time()
+        playlist = Playlist(model)
+        row = playlist.step(None, 1)
+        while row is not None:
+            steps += 1
+            model[row][COL_PATH]
+            row = playlist.step(row, 1)
+        seconds += time.time() - start
+    return steps, 0, seconds
+
+
+def bench_decoding(root):
+    files = size = 0
+    for wav in _wav_files(root):
+        with wav:
+            for block in wav.normalised_chunks():
+                pass
+        files += 1
+        size += os.path.getsize(wav.filename)
+    return files, size
+
+
+def bench_peaks(root):
+    files = size = 0
+    for wav in _wav_files(root):
+        with wav:
+            wav.pyramid()
+        files += 1
+        size += os.path.getsize(wav.filename)
+    return files, size
+
+
+def bench_discovery(root):
+    metadata = MetadataService()
+    files = 0
+    for path in find_audio_files(root):
+        metadata.discover(path)
+        files += 1
+    return files, 0
+
+
+benchmarks = OrderedDict([
+    ("listing", bench_listing),
+    ("cells", bench_cells),
+    ("next-track", bench_next_track),
+    ("decoding", bench_decoding),
+    ("peaks", bench_peaks),
+    ("discovery", bench_discovery),
+])
+
+
+def run_benchmark(job):
+    """Run benchmark `name` over root `repeat` times; keep the fastest run and the peak RSS."""
+    import resource
+    name, root, repeat = job
+    best = None
+    for n in range(repeat):
+        start = time.time()
+        result = benchmarks[name](root)
+        # some benchmarks only time part of their work
+        seconds = result[2] if len(result) > 2 else time.time() - start
+        if best is None or seconds < best:
+            best = seconds
+    items, size = result[:2]
+    return OrderedDict([
+        ("name", name),
+        ("items", items),
+        ("bytes", size),
+        ("seconds", best),
+        ("peak_rss_kb", resource.getrusage(resource.RUSAGE_SELF).ru_maxrss),
+    ])
+
+
+def benchmark(root=None, scale=1.0, baseline=None, save_baseline=None, threshold=0.2, repeat=3, out=sys.stdout):
+    """
+    Time each of `benchmarks` over the audio files below root, in a
+    process of its own so that its peak memory can be told apart, and
+    print their throughput. Without root, or if root is empty, a
+    synthetic library is generated first (and removed afterwards if no
+    root was given). Files are read from a warm page cache.
+
+    With a `baseline` JSON file of earlier results, returns the number of
+    benchmarks that got more than `threshold` slower.
+    """
+    import tempfile, shutil
+    tmp = None
+    if root is None:
+        root = tmp = tempfile.mkdtemp(prefix="bnp-benchmark-")
+    try:
+        if not os.path.isdir(root) or not os.listdir(root):
+            out.write("generating sample library in %s\n" % root)
+            make_sample_library(root, scale)
+        pool = multiprocessing.Pool(1, maxtasksperchild=1)
+        try:
+            results = pool.map(run_benchmark, [(name, root, repeat) for name in benchmarks], 1)
+            pool.close()
+        except BaseException:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    finally:
+        if tmp:
+            shutil.rmtree(tmp)
+
+    previous = {}
+    if baseline:
+        with open(baseline) as f:
+            previous = json.load(f)
+    regressions = 0
+    for result in results:
+        rate = result["items"] / result["seconds"] if result["seconds"] else 0
+        line = "%-12s %8d items %9.3f s %11.0f /s" % (result["name"], result["items"], result["seconds"], rate)
+        if result["bytes"]:
+            line += " %8.1f MB/s" % (result["bytes"] / result["seconds"] / 1024 ** 2)
+        else:
+            line += " " * 13
+        line += " %8.1f MB peak" % (result["peak_rss_kb"] / 1024.0)
+        before = previous.get(result["name"])
+        if before and before["seconds"] and before["items"] == result["items"]:
+            change = result["seconds"] / before["seconds"] - 1
+            line += "  %+6.1f%%" % (change * 100)
+            if change > threshold:
+                line += "  SLOWER"
+                regressions += 1
+        out.write(line + "\n")
+    if save_baseline:
+        with open(save_baseline, "w") as f:
+            json.dump(OrderedDict((result["name"], result) for result in results), f, indent=2)
+    return regressions
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Simple sound sample auditor")
+    parser.add_argument("paths", nargs="*", metavar="DIR",
+                        help="folder to open; every folder given is indexed for search")
+    parser.add_argument("--analyze", metavar="DIR",
+                        help="analyze the audio files below DIR without a GUI, then exit")
+    parser.add_argument("--find-duplicates", metavar="DIR",
+                        help="list the groups of identical or nearly identical audio files below DIR, then exit")
+    parser.add_argument("--format", choices=("csv", "json"), default="csv",
+                        help="output format of --analyze and --find-duplicates (default: csv)")
+    parser.add_argument("-o", "--output", metavar="FILE",
+                        help="write the output of --analyze or --find-duplicates to FILE instead of stdout")
+    parser.add_argument("-j", "--jobs", type=int, default=0,
+                        help="worker processes for --analyze and --find-duplicates (default: one per core)")
+    parser.add_argument("--startup-profile", action="store_true",
+                        help="print the time to the first frame of the window, then exit")
+    parser.add_argument("--latency-log", metavar="FILE",
+                        help="dump the latency stats to FILE as JSON on exit (also $BNP_LATENCY_LOG)")
+    parser.add_argument("--benchmark", nargs="?", const="", metavar="DIR",
+                        help="time listing, decoding, peaks and discovery over the audio files below DIR"
+                        " (generated there first if empty, or in a temporary folder), then exit")
+    parser.add_argument("--scale", type=float, default=1.0,
+                        help="number of files of the generated --benchmark library, relative to the default")
+    parser.add_argument("--baseline", metavar="FILE",
+                        help="compare the --benchmark results with those saved in FILE, fail if 20%% slower")
+    parser.add_argument("--save-baseline", metavar="FILE",
+                        help="save the --benchmark results to FILE")
+    return parser.parse_args(argv)
+
+
+class StartupProfile(object):
+    """
+    Times the startup phases up to the first frame of `window`, then
+    prints them with the lazily imported modules that got loaded anyway,
+    and quits.
+    """
+
+    lazy_modules = ["matplotlib", "gst.pbutils", "scipy"]
+
+    def __init__(self):
+        self.marks = [("start", startup_time)]
+
+    def mark(self, name):
+        self.marks.append((name, time.time()))
+
+    def watch(self, window):
+        window.connect_after("expose-event", self.on_first_frame)
+
+    def on_first_frame(self, window, event):
+        self.mark("first frame")
+        self.report()
+        gtk.main_quit()
+        return False
+
+    def report(self, out=sys.stderr):
+        previous = startup_time
+        for name, when in self.marks[1:]:
+            out.write("%-16s %8.1f ms  (+%.1f ms)\n" % (name, (when - startup_time) * 1000, (when - previous) * 1000))
+            previous = when
+        loaded = [m for m in self.lazy_modules if m in sys.modules]
+        out.write("time to first frame: %.1f ms\n" % ((previous - startup_time) * 1000))
+        out.write("lazy modules loaded: %s\n" % (", ".join(loaded) or "none"))
 
 
 def main():
     gtk.main()
 
 if __name__ == "__main__":
-    GUI()
+    options = parse_args(sys.argv[1:])
+    if options.analyze:
+        output = open(options.output, "wb") if options.output else sys.stdout
+        failed = analyze(os.path.abspath(options.analyze), output, options.format, options.jobs)
+        output.close()
+        sys.exit(1 if failed else 0)
+    if options.find_duplicates:
+        output = open(options.output, "wb") if options.output else sys.stdout
+        find_duplicates(os.path.abspath(options.find_duplicates), output, options.format, options.jobs)
+        output.close()
+        sys.exit(0)
+    if options.benchmark is not None:
+        regressions = benchmark(options.benchmark or None, options.scale, options.baseline, options.save_baseline)
+        sys.exit(1 if regressions else 0)
+    if options.paths:
+        clipath = options.paths[0]
+    library_roots = [os.path.abspath(p) for p in options.paths if os.path.isdir(p)]
+    if options.latency_log:
+        latency_log = options.latency_log
+    if options.startup_profile:
+        profile = StartupProfile()
+        profile.mark("imports")
+        gui = GUI()
+        profile.mark("window built")
+        profile.watch(gui.window)
+    else:
+        GUI()
     main()